@@ -0,0 +1,253 @@
+"""Measures how long it takes to get many accounts online, against fake login APIs and stub game clients.
+
+Run from the repository root:
+
+    python -m benchmarks.launch --accounts 8 --profile mixed --output launch.json
+"""
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+import yaml
+
+from benchmarks.login_server import serve, validate_scripts
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STUB_CLIENT = '''#!/bin/sh
+echo "stub client started with $@"
+exec sleep 600
+'''
+
+PROFILES = {
+    'ok': dict(
+        clash=[[dict(kind='ok')]],
+        rewritten=[[dict(kind='ok')]],
+    ),
+    'queue': dict(
+        clash=[[dict(kind='busy'), dict(kind='ok')]],
+        rewritten=[[dict(kind='delayed', position=3), dict(kind='delayed', position=1), dict(kind='ok')]],
+    ),
+    'mixed': dict(
+        clash=[[dict(kind='ok')], [dict(kind='rate_limited'), dict(kind='ok')], [dict(kind='garbled'), dict(kind='ok')],
+               [dict(kind='busy'), dict(kind='ok')], [dict(kind='cloudflare')], [dict(kind='bad_token')],
+               [dict(kind='toonstep')]],
+        rewritten=[[dict(kind='ok')], [dict(kind='delayed', position=2), dict(kind='ok')],
+                   [dict(kind='partial'), dict(kind='ok')], [dict(kind='rejected')]],
+    ),
+}
+
+
+def make_scripts(games: list, accounts: int, profile: dict) -> dict:
+    return {game: {f'user{index}': script for index, script in zip(range(accounts), itertools.cycle(profile[game]))}
+            for game in games}
+
+
+def write_workspace(workspace: str, scripts: dict, urls: dict):
+    """Writes config.yaml and accounts.yaml pointing the launcher at the fake APIs and the stub client."""
+    with open(os.path.join(REPOSITORY, 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+
+    stub = os.path.join(workspace, 'stub-client')
+    rewritten_prefix = os.path.join(workspace, 'ttr')
+    os.makedirs(rewritten_prefix, exist_ok=True)
+    for path in (stub, os.path.join(rewritten_prefix, 'TTREngine')):
+        with open(path, 'w') as f:
+            f.write(STUB_CLIENT)
+        os.chmod(path, 0o755)
+
+    config['Games']['CorporateClash'].update(
+        prefix=os.path.join(workspace, 'clash'), token_api=urls['token_api'], login_api=urls['login_api'])
+    config['Games']['ToontownRewritten'].update(prefix=rewritten_prefix, api_path=urls['api_path'])
+    config['Handlers']['Windows'].update(wine_executable=stub, persistent_server=0, path_index='cache/wine_paths.json')
+    config['Resources']['spread'] = 0
+    with open(os.path.join(workspace, 'config.yaml'), 'w') as f:
+        yaml.dump(config, f)
+
+    accounts = {}
+    for game, logins in scripts.items():
+        for login in logins:
+            account = dict(game=game, login=login, display_name=f'{game}-{login}')
+            if game == 'clash':
+                account['token'] = f'token-{login}'
+            else:
+                account['password'] = 'password'
+            accounts[account['display_name']] = account
+
+    with open(os.path.join(workspace, 'accounts.yaml'), 'w') as f:
+        yaml.dump(accounts, f)
+    try:
+        os.remove(os.path.join(workspace, 'accounts.yaml.journal'))
+    except FileNotFoundError:
+        pass
+    return sorted(accounts)
+
+
+class Sampler(threading.Thread):
+    def __init__(self, interval: float = 0.005):
+        super().__init__(name='benchmark-sampler', daemon=True)
+        self.interval = interval
+        self.peak_threads = self.peak_sockets = 0
+        self.running = True
+
+    @staticmethod
+    def sockets() -> int:
+        count = 0
+        for fd in os.listdir('/proc/self/fd'):
+            try:
+                count += os.readlink(f'/proc/self/fd/{fd}').startswith('socket:')
+            except OSError:
+                pass
+        return count
+
+    def run(self):
+        while self.running:
+            # The sampler itself is not counted
+            self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+            self.peak_sockets = max(self.peak_sockets, self.sockets())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def run_launch(workspace: str, toons: list, parallel: bool, timeout: float, verbose: bool) -> dict:
+    """Runs in a fresh process so the rate limits, sessions and the scheduler start out empty."""
+    os.chdir(workspace)
+    # Answers for the two-factor prompts
+    sys.stdin = io.StringIO('000000\n' * len(toons) * 4)
+
+    from code.game import corporate_clash, rewritten  # noqa: F401
+    from code.scheduler import login_scheduler
+    from code.shell import ToonLinuxShell
+
+    online = {}
+
+    class BenchmarkShell(ToonLinuxShell):
+        def register_game(self, game):
+            online[game.account['display_name']] = time.perf_counter()
+            super().register_game(game)
+
+    log = sys.stderr if verbose else open(os.devnull, 'w')
+    with redirect_stdout(log):
+        shell = BenchmarkShell()
+        baseline_threads, baseline_sockets = threading.active_count(), Sampler.sockets()
+        sampler = Sampler()
+        sampler.start()
+
+        started = time.perf_counter()
+        shell.do_launch(' '.join(toons) + f' parallel={str(parallel).lower()}')
+        for job in shell.jobs.list():
+            job.wait()
+        launch_returned = time.perf_counter() - started
+        deadline = started + timeout
+        while login_scheduler.pending() and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        wall = time.perf_counter() - started
+
+        sampler.stop()
+        timed_out = [f'{game}-{login}' for (game, login), _, _ in login_scheduler.pending()]
+        for _, game in shell.launched():
+            if game.is_active():
+                game.stop()
+
+    accounts = {}
+    for toon in toons:
+        if toon in online:
+            accounts[toon] = dict(outcome='online', time_to_online=online[toon] - started)
+        else:
+            accounts[toon] = dict(outcome='timeout' if toon in timed_out else 'failed', time_to_online=None)
+
+    return dict(
+        wall=wall, launch_returned=launch_returned, accounts=accounts,
+        baseline_threads=baseline_threads, peak_threads=sampler.peak_threads,
+        baseline_sockets=baseline_sockets, peak_sockets=sampler.peak_sockets)
+
+
+def summarize(run: dict) -> dict:
+    times = sorted(account['time_to_online'] for account in run['accounts'].values() if account['outcome'] == 'online')
+    return dict(
+        online=len(times), failed=len(run['accounts']) - len(times), wall=run['wall'],
+        median_time_to_online=statistics.median(times) if times else None,
+        max_time_to_online=times[-1] if times else None,
+        peak_threads=run['peak_threads'], peak_sockets=run['peak_sockets'])
+
+
+def run_benchmark(args) -> dict:
+    if args.script:
+        with open(args.script, 'r') as f:
+            scripts = json.load(f)
+    else:
+        scripts = make_scripts(args.games, args.accounts, PROFILES[args.profile])
+    validate_scripts(scripts)
+
+    context = multiprocessing.get_context('spawn')
+    workspace = tempfile.mkdtemp(prefix='toony-launch-')
+    results = {}
+    try:
+        for mode in args.modes:
+            parent, child = context.Pipe()
+            server = context.Process(target=serve, args=(scripts, args.latency, child), daemon=True)
+            server.start()
+            toons = write_workspace(workspace, scripts, parent.recv())
+            try:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    run = executor.submit(run_launch, workspace, toons, mode == 'parallel', args.timeout,
+                                          args.verbose).result()
+            finally:
+                parent.send(None)
+                run_requests = parent.recv()
+                server.join()
+
+            run['server_requests'] = run_requests
+            results[mode] = dict(summary=summarize(run), run=run)
+            summary = results[mode]['summary']
+            print(f'{mode}: {summary["online"]} online, {summary["failed"]} failed in {summary["wall"]:.2f}s, '
+                  f'{summary["peak_threads"]} threads, {summary["peak_sockets"]} sockets', file=sys.stderr)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    return dict(meta=dict(profile=None if args.script else args.profile, accounts=sum(map(len, scripts.values())),
+                          latency=args.latency, cpu_count=os.cpu_count()),
+                results=results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark multi-account logins against fake login APIs.')
+    parser.add_argument('--games', nargs='+', choices=['clash', 'rewritten'], default=['clash', 'rewritten'])
+    parser.add_argument('--accounts', type=int, default=4, help='accounts per game')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='ok', help='scripted server behaviour')
+    parser.add_argument('--script', help='JSON file with {game: {login: [steps]}} instead of a profile')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds the fake APIs take per request')
+    parser.add_argument('--modes', nargs='+', choices=['parallel', 'sequential'], default=['parallel', 'sequential'])
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for queued logins')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='show the launcher output')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
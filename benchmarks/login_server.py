@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs
+
+CLOUDFLARE_PAGE = '<!DOCTYPE html><html lang="en-US"><head><title>Just a moment...</title></head></html>'
+
+# Response kinds each fake API understands, a script is a list of {"kind": ..., "latency": ..., "position": ...}
+CLASH_KINDS = {'ok', 'rate_limited', 'cloudflare', 'garbled', 'busy', 'bad_token', 'toonstep', 'rejected'}
+REWRITTEN_KINDS = {'ok', 'delayed', 'partial', 'rejected'}
+
+
+class LoginRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'LoginServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        if self.path == '/clash/register':
+            self.clash_register(form)
+        elif self.path == '/clash/login':
+            self.clash_login()
+        elif self.path == '/ttr/login':
+            self.rewritten_login(form)
+        else:
+            self.reply(404, 'Not found', 'text/plain')
+
+    def reply(self, code: int, body, content_type: str = 'application/json'):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        data = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def clash_register(self, form: dict):
+        username = form.get('username', '')
+        self.server.wait(self.server.latency)
+        self.reply(200, dict(status=True, token=f'token-{username}'))
+
+    def clash_login(self):
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        username = token.removeprefix('token-')
+        step = self.server.next_step('clash', username)
+        kind = step['kind']
+        if kind == 'ok':
+            self.reply(200, dict(status=True, token=f'cookie-{username}'))
+        elif kind == 'rate_limited':
+            self.reply(429, 'Too Many Requests', 'text/plain')
+        elif kind == 'cloudflare':
+            self.reply(403, CLOUDFLARE_PAGE, 'text/html')
+        elif kind == 'garbled':
+            self.reply(200, '<html><body>Blocked by your provider</body></html>', 'text/html')
+        elif kind == 'busy':
+            self.reply(200, dict(status=False, message='A lot of Toons are logging in right now, try again later'))
+        elif kind == 'bad_token':
+            self.reply(200, dict(status=False, bad_token=True, message='Bad token'))
+        elif kind == 'toonstep':
+            self.reply(200, dict(status=False, toonstep=True, message='Authorize this login'))
+        else:
+            self.reply(200, dict(status=False, message='Login rejected'))
+
+    def rewritten_login(self, form: dict):
+        if 'queueToken' in form:
+            username = form['queueToken'].split(':', 1)[1]
+        elif 'authToken' in form:
+            username = form['authToken'].split(':', 1)[1]
+        else:
+            username = form.get('username', '')
+
+        step = self.server.next_step('rewritten', username)
+        kind = step['kind']
+        if kind == 'ok':
+            self.reply(200, dict(success='true', gameserver='127.0.0.1:7198', cookie=f'cookie-{username}'))
+        elif kind == 'delayed':
+            self.reply(200, dict(success='delayed', position=str(step.get('position', 1)),
+                                 queueToken=f'queue:{username}'))
+        elif kind == 'partial':
+            self.reply(200, dict(success='partial', responseToken=f'auth:{username}', banner='Enter your token'))
+        else:
+            self.reply(200, dict(success='false', banner='Incorrect username or password'))
+
+
+class LoginServer(ThreadingHTTPServer):
+    """Fake Clash and TTR login APIs answering every account with its own script of responses.
+
+    Each request consumes the next step of the account's script, the last step repeats forever.
+    """
+    daemon_threads = True
+
+    def __init__(self, scripts: Dict[str, Dict[str, List[dict]]], latency: float = 0.0,
+                 host: str = '127.0.0.1', port: int = 0):
+        super().__init__((host, port), LoginRequestHandler)
+        self.lock = threading.Lock()
+        self.scripts = {game: {login: list(steps) for login, steps in accounts.items()}
+                        for game, accounts in scripts.items()}
+        self.latency = latency
+        self.requests = 0
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def urls(self) -> dict:
+        return dict(token_api=f'{self.base_url}/clash/register', login_api=f'{self.base_url}/clash/login',
+                    api_path=f'{self.base_url}/ttr/login')
+
+    def next_step(self, game: str, login: str) -> dict:
+        with self.lock:
+            self.requests += 1
+            steps = self.scripts.get(game, {}).get(login) or [dict(kind='ok')]
+            step = steps.pop(0) if len(steps) > 1 else steps[0]
+        self.wait(step.get('latency', self.latency))
+        return step
+
+    @staticmethod
+    def wait(latency: float):
+        if latency:
+            time.sleep(latency)
+
+
+def validate_scripts(scripts: Dict[str, Dict[str, List[dict]]]):
+    kinds = dict(clash=CLASH_KINDS, rewritten=REWRITTEN_KINDS)
+    for game, accounts in scripts.items():
+        if game not in kinds:
+            raise ValueError(f'Unknown game {game}')
+        for login, steps in accounts.items():
+            for step in steps:
+                if step['kind'] not in kinds[game]:
+                    raise ValueError(f'{game} script of {login} has an unknown step {step["kind"]}')
+
+
+def serve(scripts: dict, latency: float, connection):
+    """Process entry point, sends the base URL over the connection and serves until it is closed."""
+    server = LoginServer(scripts, latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection.send(server.urls())
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    connection.send(server.requests)
+    server.shutdown()
@@ -0,0 +1,170 @@
+import bz2
+import gzip
+import hashlib
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+
+def sha1(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+class PatchRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'PatchServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        published = self.server.lookup(self.path)
+        if published is None:
+            self.send_error(404)
+            return
+
+        data, etag = published
+        if self.headers.get('If-None-Match') == etag:
+            self.server.count(self.path, 0)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start = 0
+        byte_range = self.headers.get('Range', '')
+        if byte_range.startswith('bytes=') and byte_range.endswith('-'):
+            start = int(byte_range[6:-1])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        body = data[start:]
+        self.server.count(self.path, len(body))
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PatchServer(ThreadingHTTPServer):
+    """Serves published blobs from memory, with ETags and resumable ranges like the real patch CDNs."""
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        super().__init__((host, port), PatchRequestHandler)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.requests = 0
+        self.bytes_sent = 0
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def publish(self, path: str, data: bytes):
+        with self.lock:
+            self.files[path] = (data, f'"{sha1(data)}"')
+
+    def unpublish(self, prefix: str):
+        with self.lock:
+            self.files = {path: value for path, value in self.files.items() if not path.startswith(prefix)}
+
+    def lookup(self, path: str) -> Optional[tuple]:
+        with self.lock:
+            return self.files.get(path)
+
+    def count(self, path: str, sent: int):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += sent
+
+    def reset_counters(self) -> dict:
+        with self.lock:
+            counters = dict(requests=self.requests, bytes_sent=self.bytes_sent)
+            self.requests = self.bytes_sent = 0
+        return counters
+
+
+def random_content(rng: random.Random, size: int, compressibility: float) -> bytes:
+    # Repeating a random block gives the compressor something to do without making the archive trivial
+    unique = max(1, int(size * (1 - compressibility)))
+    block = rng.randbytes(min(unique, 64 * 1024))
+    data = bytearray(rng.randbytes(unique))
+    while len(data) < size:
+        data += block
+    return bytes(data[:size])
+
+
+def generate_tree(seed: int, files: int, median_size: int, sigma: float, large_files: int, large_size: int,
+                  compressibility: float) -> Dict[str, bytes]:
+    """Builds a synthetic game with a log-normal file size distribution and a few large resource packs."""
+    rng = random.Random(seed)
+    tree = {}
+    for index in range(files):
+        size = max(1, int(rng.lognormvariate(0, sigma) * median_size))
+        tree[f'resources/phase_{index % 14}/file_{index}.bin'] = random_content(rng, size, compressibility)
+    for index in range(large_files):
+        tree[f'resources/default/pack_{index}.mf'] = random_content(rng, large_size, compressibility)
+    return tree
+
+
+def mutate_tree(tree: Dict[str, bytes], fraction: float, seed: int) -> Dict[str, bytes]:
+    rng = random.Random(seed)
+    mutated = dict(tree)
+    for path in rng.sample(sorted(tree), max(1, int(len(tree) * fraction))):
+        data = bytearray(tree[path])
+        position = rng.randrange(len(data))
+        data[position:position + 16] = rng.randbytes(16)
+        mutated[path] = bytes(data)
+    return mutated
+
+
+def publish_clash(server: PatchServer, tree: Dict[str, bytes], prefix: str = '/clash') -> dict:
+    """Publishes the tree the way Corporate Clash does: gzip archives named by the SHA-1 of path + manifest."""
+    server.unpublish(prefix)
+    manifests = {'windows': [], 'resources': []}
+    for path, data in tree.items():
+        manifest_name = 'windows' if path.endswith('.exe') or '/' not in path else 'resources'
+        archive = gzip.compress(data, compresslevel=6, mtime=0)
+        server.publish(f'{prefix}/files/{sha1((path + manifest_name).encode())}', archive)
+        manifests[manifest_name].append(dict(
+            fileName=path.split('/')[-1], filePath=path, sha1=sha1(data), compressed_sha1=sha1(archive)))
+
+    for manifest_name, files in manifests.items():
+        server.publish(f'{prefix}/manifest/{manifest_name}', json.dumps(dict(files=files)).encode())
+    return dict(manifest_files=[f'{server.base_url}{prefix}/manifest/{name}' for name in manifests],
+                update_url=f'{server.base_url}{prefix}/files/')
+
+
+def publish_rewritten(server: PatchServer, tree: Dict[str, bytes], prefix: str = '/ttr') -> dict:
+    """Publishes the tree the way Toontown Rewritten does: one manifest and bzip2 archives."""
+    server.unpublish(prefix)
+    manifest = {}
+    for path, data in tree.items():
+        archive = bz2.compress(data, compresslevel=9)
+        download_name = f'{path.replace("/", "_")}.{sha1(data)[:8]}.bz2'
+        server.publish(f'{prefix}/patches/{download_name}', archive)
+        manifest[path] = dict(only=['linux2'], hash=sha1(data), compHash=sha1(archive), dl=download_name)
+
+    server.publish(f'{prefix}/patchmanifest.txt', json.dumps(manifest).encode())
+    return dict(manifest_files=[f'{server.base_url}{prefix}/patchmanifest.txt'],
+                update_url=f'{server.base_url}{prefix}/patches/')
@@ -0,0 +1,227 @@
+"""Times Updater.run against a local stand-in for the patch servers.
+
+Run from the repository root so config.yaml is found:
+
+    python -m benchmarks.updater --files 300 --output results.json
+    python -m benchmarks.updater --compare results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from threading import Lock
+
+from benchmarks.patch_server import PatchServer, generate_tree, mutate_tree, publish_clash, publish_rewritten
+
+# name, force, verify, publish a changed release first
+SCENARIOS = [
+    ('cold', False, False, False),
+    ('noop', False, False, False),
+    ('verify', False, True, False),
+    ('warm', False, False, True),
+]
+
+GAMES = {
+    'clash': ('CorporateClash', 'CorporateClash.exe', publish_clash),
+    'rewritten': ('ToontownRewritten', 'TTREngine', publish_rewritten),
+}
+
+
+class StageTimer:
+    def __init__(self):
+        self.lock = Lock()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    @contextmanager
+    def measure(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.seconds[stage] += elapsed
+                self.calls[stage] += 1
+
+
+def timed_classes(base, timer: StageTimer, release: dict):
+    from code import common
+
+    class TimedArchiveStream(common.ArchiveStream):
+        # Decompressing, hashing and writing happen in a single pass, these are summed over all download threads
+        def feed(self, data: bytes):
+            with timer.measure('extract'):
+                super().feed(data)
+
+        def check(self, url: str, archive_hash: str, file_hash: str):
+            with timer.measure('verify'):
+                super().check(url, archive_hash, file_hash)
+
+    class TimedUpdater(base):
+        manifest_files = release['manifest_files']
+        update_url = release['update_url']
+
+        def get_patch_manifest(self):
+            with timer.measure('manifest'):
+                super().get_patch_manifest()
+
+        def cached_files_match(self) -> bool:
+            with timer.measure('cached_files_match'):
+                return super().cached_files_match()
+
+        def check_local_files(self, *args, **kwargs):
+            with timer.measure('check_local_files'):
+                super().check_local_files(*args, **kwargs)
+
+        def download_game_files(self):
+            with timer.measure('download'):
+                super().download_game_files()
+
+        def replace_game_files(self):
+            with timer.measure('replace_game_files'):
+                super().replace_game_files()
+
+    return TimedArchiveStream, TimedUpdater
+
+
+def run_scenario(game: str, release: dict, game_dir: str, force: bool, verify: bool) -> dict:
+    """Runs in a fresh process so the peak RSS belongs to this scenario alone."""
+    from code import common
+    from code.game.corporate_clash import ClashPatcher
+    from code.game.rewritten import RewrittenUpdater
+    from code.session import get_session
+
+    base = ClashPatcher if game == 'clash' else RewrittenUpdater
+    timer = StageTimer()
+    common.ArchiveStream, updater_class = timed_classes(base, timer, release)
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        updater_class(game_dir, get_session(GAMES[game][0])).run(force=force, verify=verify)
+    wall = time.perf_counter() - started
+
+    return dict(
+        wall=wall, stages=dict(timer.seconds), files_downloaded=timer.calls['verify'],
+        baseline_rss_kb=baseline_rss, peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def run_benchmark(args) -> dict:
+    from code.common import Config
+
+    base_tree = generate_tree(args.seed, args.files, args.median_size, args.sigma, args.large_files,
+                              args.large_size, args.compressibility)
+    context = multiprocessing.get_context('spawn')
+    server = PatchServer().start()
+    results = {}
+    try:
+        for game in args.games:
+            session_name, executable, publish = GAMES[game]
+            tree = dict(base_tree)
+            tree[executable] = os.urandom(256 * 1024)
+            results[game] = defaultdict(list)
+
+            for repeat in range(args.repeat):
+                release = publish(server, tree)
+                game_dir = tempfile.mkdtemp(prefix=f'{game}-', dir=args.workdir)
+                try:
+                    for name, force, verify, mutate in SCENARIOS:
+                        if mutate:
+                            release = publish(server, mutate_tree(tree, args.changed, args.seed + repeat))
+                        server.reset_counters()
+                        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                            result = executor.submit(run_scenario, game, release, game_dir, force, verify).result()
+                        result.update(server.reset_counters())
+                        results[game][name].append(result)
+                        print(f'{game} {name} #{repeat + 1}: {result["wall"]:.3f}s, '
+                              f'{result["files_downloaded"]} files, {result["bytes_sent"] / 1024 / 1024:.1f} MB',
+                              file=sys.stderr)
+                finally:
+                    shutil.rmtree(game_dir, ignore_errors=True)
+    finally:
+        server.stop()
+
+    return dict(
+        meta=dict(
+            python=platform.python_version(), machine=platform.machine(), cpu_count=os.cpu_count(),
+            download_workers=Config().Updater.download_workers, hash_workers=Config().Updater.hash_workers,
+            tree=dict(files=len(base_tree) + 1, bytes=sum(map(len, base_tree.values())), seed=args.seed,
+                      median_size=args.median_size, sigma=args.sigma, large_files=args.large_files,
+                      large_size=args.large_size, compressibility=args.compressibility, changed=args.changed)),
+        results={game: {name: dict(median=summarize(runs), runs=runs) for name, runs in scenarios.items()}
+                 for game, scenarios in results.items()})
+
+
+def summarize(runs: list) -> dict:
+    stages = {stage for run in runs for stage in run['stages']}
+    return dict(
+        wall=statistics.median(run['wall'] for run in runs),
+        peak_rss_kb=statistics.median(run['peak_rss_kb'] for run in runs),
+        stages={stage: statistics.median(run['stages'].get(stage, 0) for run in runs) for stage in sorted(stages)})
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for game, scenarios in current['results'].items():
+        for name, result in scenarios.items():
+            old = baseline['results'].get(game, {}).get(name)
+            if not old:
+                continue
+            for metric in ('wall', 'peak_rss_kb'):
+                before, after = old['median'][metric], result['median'][metric]
+                if before and after > before * (1 + threshold):
+                    regressions.append(f'{game} {name} {metric}: {before:.3f} -> {after:.3f}')
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the game updaters against a local patch server.')
+    parser.add_argument('--games', nargs='+', choices=sorted(GAMES), default=sorted(GAMES))
+    parser.add_argument('--files', type=int, default=300, help='small files in the synthetic game')
+    parser.add_argument('--median-size', type=int, default=32 * 1024, help='median small file size in bytes')
+    parser.add_argument('--sigma', type=float, default=1.2, help='spread of the log-normal file size distribution')
+    parser.add_argument('--large-files', type=int, default=2, help='resource packs added on top of the small files')
+    parser.add_argument('--large-size', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--compressibility', type=float, default=0.5, help='0 gives incompressible files')
+    parser.add_argument('--changed', type=float, default=0.05, help='share of files changed in the warm update')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=None, help='where the game directories are created')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--compare', help='baseline JSON from an earlier run, exits with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown against the baseline')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import copy
+import json
+import os
+from threading import RLock
+from typing import Optional, Tuple
+
+import yaml
+
+from code.cache import atomic_write
+
+# Keys that may be added to an account at runtime and still be written back. Anything else that appears
+# later (like a password typed in at launch) only lives for the session.
+PERSISTED_NEW_KEYS = {'token'}
+
+
+class AccountStore:
+    """accounts.yaml with indexes on name, alias and (game, login).
+
+    Changes to single accounts are appended to a journal next to the file instead of rewriting it,
+    the journal is folded back into accounts.yaml once it grows past journal_limit entries.
+    The top-level "groups" key is not an account, it maps launch group names to lists of toons.
+    """
+
+    def __init__(self, path: str, games, journal_limit: int):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.games = games
+        self.journal_limit = journal_limit
+        self.lock = RLock()
+
+        self.accounts = {}
+        self.aliases = {}
+        self.logins = {}
+        self.groups = {}
+        self.persisted = {}
+        self.journal_entries = 0
+        self.mtime = None
+
+        self.load()
+
+    def stat_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        with self.lock:
+            mtime = self.stat_mtime()
+            with open(self.path, 'r') as f:
+                accounts = yaml.safe_load(f) or {}
+            groups = accounts.pop('groups', None) or {}
+
+            self.journal_entries = 0
+            try:
+                with open(self.journal_path, 'r') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            break  # torn write at the end of the journal
+                        self.journal_entries += 1
+                        account = accounts.get(entry['account'])
+                        if account is None:
+                            continue
+                        # A key that no longer has the value the change was made to was edited by hand since
+                        was = entry.get('was', {})
+                        for key, value in entry['set'].items():
+                            if key not in was or account.get(key) == was[key]:
+                                account[key] = value
+                        for key in entry['unset']:
+                            if key not in was or account.get(key) == was[key]:
+                                account.pop(key, None)
+            except FileNotFoundError:
+                pass
+
+            aliases, logins = {}, {}
+            for name, account in accounts.items():
+                if account['game'] not in self.games:
+                    raise ValueError(f'Unknown game {account["game"]}')
+                for alias in account.get('aliases', []):
+                    aliases[str(alias)] = name
+                logins[account['game'], account['login']] = name
+
+            for group, toons in groups.items():
+                for toon in toons:
+                    if str(toon) not in accounts and str(toon) not in aliases:
+                        raise ValueError(f'Unknown account {toon} in group {group}')
+
+            self.accounts = accounts
+            self.aliases = aliases
+            self.logins = logins
+            self.groups = {str(group): [str(toon) for toon in toons] for group, toons in groups.items()}
+            self.persisted = copy.deepcopy(accounts)
+            self.mtime = mtime
+
+    def refresh(self):
+        # Picks up edits made to accounts.yaml outside of the shell
+        if self.stat_mtime() != self.mtime:
+            print('accounts.yaml changed, reloading the accounts')
+            self.load()
+
+    def resolve(self, name: str) -> Optional[str]:
+        self.refresh()
+        if name in self.accounts:
+            return name
+        return self.aliases.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return self.resolve(name) is not None
+
+    def __getitem__(self, name: str) -> dict:
+        resolved = self.resolve(name)
+        if resolved is None:
+            raise KeyError(name)
+        return self.accounts[resolved]
+
+    def get(self, name: str, default=None) -> Optional[dict]:
+        resolved = self.resolve(name)
+        return self.accounts[resolved] if resolved is not None else default
+
+    def by_login(self, game: str, login: str) -> Tuple[Optional[str], Optional[dict]]:
+        self.refresh()
+        name = self.logins.get((game, login))
+        return name, self.accounts.get(name)
+
+    def save(self, account: dict):
+        with self.lock:
+            name, current = self.by_login(account['game'], account['login'])
+            if name is None:
+                return
+
+            persisted = self.persisted[name]
+            changes = {key: value for key, value in account.items()
+                       if (key in persisted or key in PERSISTED_NEW_KEYS) and persisted.get(key) != value}
+            removed = [key for key in persisted if key not in account]
+            if not changes and not removed:
+                return
+
+            was = {key: persisted.get(key) for key in [*changes, *removed]}
+            entry = dict(account=name, set=changes, unset=removed, was=was)
+            # Holds tokens, so only the user may read it
+            with open(os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_entries += 1
+
+            persisted.update(copy.deepcopy(changes))
+            for key in removed:
+                persisted.pop(key, None)
+            if current is not account:
+                # The account was reloaded while this copy was in use
+                current.update(changes)
+                for key in removed:
+                    current.pop(key, None)
+
+            if self.journal_entries >= self.journal_limit:
+                self.compact()
+
+    def compact(self):
+        with self.lock:
+            document = dict(self.persisted, groups=self.groups) if self.groups else self.persisted
+            atomic_write(self.path, yaml.dump(document), mode=0o600)
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+            self.journal_entries = 0
+            self.mtime = self.stat_mtime()
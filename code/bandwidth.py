@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value: str) -> int:
+    """Parses a byte rate such as "500K" or "2M", 0 and "off" mean unlimited."""
+    value = value.strip().upper().removesuffix('/S').removesuffix('B')
+    if value in ('OFF', ''):
+        return 0
+    unit = value[-1] if value[-1] in UNITS else ''
+    return int(float(value.removesuffix(unit)) * UNITS[unit])
+
+
+def format_rate(rate: float) -> str:
+    for unit in ('G', 'M', 'K'):
+        if rate >= UNITS[unit]:
+            return f'{rate / UNITS[unit]:.1f} {unit}B/s'
+    return f'{rate:.0f} B/s'
+
+
+class BandwidthLimiter:
+    """Token bucket over bytes, shared by every download thread. A rate of 0 means unlimited.
+
+    The rate can change at any time, threads waiting on the old rate pick up the new one within a fraction
+    of a second. While the rate is capped, transfers give way to every running transfer of a higher priority
+    (lower number), so small critical files are not slowed down by large ones.
+    """
+
+    def __init__(self, rate: int = 0, burst: float = 0.25):
+        self.rate = rate
+        self.burst = burst
+        self.allowance = 0.0
+        self.updated = time.monotonic()
+        self.lock = Lock()
+        self.active = Counter()
+        self.local = threading.local()
+
+    def set_rate(self, rate: int):
+        with self.lock:
+            self.rate = rate
+            self.allowance = 0.0
+            self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.allowance = min(self.rate * self.burst, self.allowance + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @contextmanager
+    def transfer(self, priority: int):
+        """Marks the calling thread as running a transfer of the given priority."""
+        with self.lock:
+            self.active[priority] += 1
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = None
+            with self.lock:
+                self.active[priority] -= 1
+
+    def preempted(self, priority: int) -> bool:
+        return any(count for other, count in self.active.items() if other < priority)
+
+    def consume(self, amount: int):
+        priority = getattr(self.local, 'priority', None)
+        charged = False
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return
+                self.refill()
+                if priority is not None and self.preempted(priority):
+                    wait = 0.05
+                else:
+                    if not charged:
+                        self.allowance -= amount
+                        charged = True
+                    if self.allowance >= 0:
+                        return
+                    wait = -self.allowance / self.rate
+            time.sleep(min(wait, 0.2))
+
+
+class TransferCounter:
+    """Counts the bytes passed through it, in total and for the transfer running on the calling thread.
+
+    Takes the place of a limiter in the download loop, so it sees the bytes as they arrive.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.lock = Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def transfer(self, priority: int):
+        self.local.count = 0
+        yield
+
+    def consume(self, amount: int):
+        with self.lock:
+            self.total += amount
+        self.local.count = getattr(self.local, 'count', 0) + amount
+
+    def current(self) -> int:
+        return getattr(self.local, 'count', 0)
+
+
+bandwidth_limiter = BandwidthLimiter()
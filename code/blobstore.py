@@ -0,0 +1,146 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from threading import Lock
+from typing import Dict, Tuple
+
+from code.cache import atomic_write
+
+# ioctl that makes the destination share the source's extents (btrfs, xfs, bcachefs)
+FICLONE = 0x40049409
+LINK_MODES = ('auto', 'hardlink', 'reflink', 'copy')
+
+
+class BlobStore:
+    """Host-wide copy of every game file, named by its SHA-1 from the manifest.
+
+    Installations get their files as hardlinks or reflinks of the blobs, so every prefix and game directory
+    on the host shares one copy. Each installation writes the list of blobs it uses into refs/, blobs that
+    no installation uses any more are removed by collect().
+    """
+
+    def __init__(self, root: str, link: str = 'auto'):
+        if link not in LINK_MODES:
+            raise ValueError(f'Unknown link mode {link}, expected one of {", ".join(LINK_MODES)}')
+        self.root = os.path.expanduser(root)
+        self.link = link
+        self.objects = os.path.join(self.root, 'objects')
+        self.refs = os.path.join(self.root, 'refs')
+        self.lock = Lock()
+
+    def blob_path(self, file_hash: str) -> str:
+        return os.path.join(self.objects, file_hash[:2], file_hash)
+
+    def has(self, file_hash: str) -> bool:
+        return os.path.isfile(self.blob_path(file_hash))
+
+    def place(self, source: str, target: str):
+        # Links or copies into a temporary name first so the target never exists half-written
+        tmp_path = f'{target}.{os.getpid()}.blob'
+        modes = ('hardlink', 'reflink', 'copy') if self.link == 'auto' else (self.link,)
+        for mode in modes:
+            try:
+                if mode == 'hardlink':
+                    os.link(source, tmp_path)
+                elif mode == 'reflink':
+                    self.reflink(source, tmp_path)
+                else:
+                    shutil.copyfile(source, tmp_path)
+                    shutil.copymode(source, tmp_path)
+                break
+            except OSError as e:
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+                if mode == modes[-1] or e.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EINVAL,
+                                                         errno.ENOTTY, errno.EMLINK):
+                    raise
+        os.replace(tmp_path, target)
+
+    @staticmethod
+    def reflink(source: str, target: str):
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copymode(source, target)
+
+    def add(self, path: str, file_hash: str) -> bool:
+        """Stores a verified file, returns False if the blob was already there."""
+        blob_path = self.blob_path(file_hash)
+        if os.path.isfile(blob_path):
+            return False
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        self.place(path, blob_path)
+        return True
+
+    def materialise(self, file_hash: str, target: str) -> bool:
+        """Puts the blob at target, returns False if the store does not have it."""
+        blob_path = self.blob_path(file_hash)
+        if not os.path.isfile(blob_path):
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        self.place(blob_path, target)
+        return True
+
+    def ref_path(self, directory: str) -> str:
+        directory = os.path.abspath(directory)
+        return os.path.join(self.refs, hashlib.sha1(directory.encode()).hexdigest() + '.json')
+
+    def reference(self, directory: str, files: Dict[str, str]):
+        """Records the blobs used by an installation, replacing what it used before."""
+        with self.lock:
+            os.makedirs(self.refs, exist_ok=True)
+            atomic_write(self.ref_path(directory), json.dumps(dict(directory=os.path.abspath(directory),
+                                                                   files=files)))
+
+    def referenced(self, prune: bool = True) -> set:
+        hashes = set()
+        try:
+            entries = os.listdir(self.refs)
+        except FileNotFoundError:
+            return hashes
+
+        for name in entries:
+            path = os.path.join(self.refs, name)
+            try:
+                with open(path, 'r') as f:
+                    refs = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            if not os.path.isdir(refs['directory']):
+                # The installation was deleted
+                if prune:
+                    os.remove(path)
+                continue
+            for file_path, file_hash in refs['files'].items():
+                if os.path.exists(os.path.join(refs['directory'], file_path)):
+                    hashes.add(file_hash)
+        return hashes
+
+    def collect(self, dry_run: bool = False) -> Tuple[int, int]:
+        """Removes blobs no installation references, returns the number of blobs and bytes freed."""
+        with self.lock:
+            referenced = self.referenced(prune=not dry_run)
+            removed = freed = 0
+            try:
+                buckets = os.listdir(self.objects)
+            except FileNotFoundError:
+                return 0, 0
+
+            for bucket in buckets:
+                with os.scandir(os.path.join(self.objects, bucket)) as entries:
+                    for entry in entries:
+                        if entry.name in referenced:
+                            continue
+                        stat = entry.stat()
+                        removed += 1
+                        # Blobs still linked into an installation do not free anything
+                        if stat.st_nlink == 1:
+                            freed += stat.st_size
+                        if not dry_run:
+                            os.remove(entry.path)
+            return removed, freed
@@ -0,0 +1,135 @@
+import json
+import os
+from threading import RLock
+from typing import Optional
+
+
+def atomic_write(path: str, data: str, mode: int = 0o666):
+    """Replaces path with data, keeping the permissions of the file it replaces. New files get mode."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.remove(tmp_path)  # left over from a crash, it would keep its old permissions
+    except FileNotFoundError:
+        pass
+    try:
+        existing = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        existing = None
+
+    # Secrets are never readable through the temporary file, the umask applies to new files as usual
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600 if existing is not None else mode)
+    if existing is not None:
+        os.fchmod(fd, existing)
+    with open(fd, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # Make the rename itself durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class HashCache:
+    """Maps game-relative paths to (size, mtime_ns, inode, sha1) so unchanged files are not rehashed."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.dirty = False
+
+    @staticmethod
+    def stat_key(stat: os.stat_result) -> list:
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def get(self, key: str, stat: os.stat_result) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry and entry[:3] == self.stat_key(stat):
+            return entry[3]
+        return None
+
+    def update(self, key: str, stat: os.stat_result, file_hash: str):
+        self.entries[key] = self.stat_key(stat) + [file_hash]
+        self.dirty = True
+
+    def discard(self, key: str):
+        if self.entries.pop(key, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        atomic_write(self.path, json.dumps(self.entries))
+        self.dirty = False
+
+
+class DownloadJournal:
+    """Remembers files that were downloaded, verified and staged by an update that did not finish.
+
+    Every staged file appends one JSON line, save() rewrites the file with only the entries still needed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = RLock()
+        self.entries = {}
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn write at the end of the journal
+                    self.entries[record.pop('key')] = record
+        except OSError:
+            pass
+
+    def is_staged(self, key: str, file_hash: str, staged_path: str) -> bool:
+        with self.lock:
+            entry = self.entries.get(key)
+        if not entry or entry['file_hash'] != file_hash or entry['staged'] != staged_path:
+            return False
+
+        try:
+            return entry['stat'] == HashCache.stat_key(os.stat(staged_path))
+        except FileNotFoundError:
+            return False
+
+    def record(self, key: str, file_hash: str, staged_path: str):
+        entry = dict(file_hash=file_hash, staged=staged_path, stat=HashCache.stat_key(os.stat(staged_path)))
+        with self.lock:
+            self.entries[key] = entry
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Not synced, the staged files are not either. A lost entry only means the file is downloaded again
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(dict(entry, key=key)) + '\n')
+
+    def discard(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def save(self):
+        with self.lock:
+            if not self.entries:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            atomic_write(self.path, ''.join(json.dumps(dict(entry, key=key)) + '\n'
+                                            for key, entry in self.entries.items()))
@@ -1,14 +1,49 @@
 import abc
+import glob
 import bz2
-import gzip
 import hashlib
+import json
 import os
+import subprocess
+import time
+import zlib
+from getpass import getpass
+from threading import Event, RLock, current_thread, main_thread
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import ExitStack, contextmanager
 from enum import Enum
-from typing import Tuple, Any, List, Optional
+from types import MappingProxyType
+from typing import Tuple, Any, List, Optional, Iterator, BinaryIO
 
 import requests
 import yaml
 
+from code.bandwidth import BandwidthLimiter, TransferCounter, bandwidth_limiter, parse_rate
+from code.blobstore import BlobStore
+from code.cache import DownloadJournal, HashCache, atomic_write
+from code.console import console
+from code.jobs import JobCancelled, checkpoint, current_job
+from code.output import output_drainer
+from code.resources import ResourcePolicy, core_allocator, parse_cpus
+from code.schema import CONFIG_SCHEMA, validate
+from code.stagger import LaunchGate
+from code.tracing import tracer
+
+
+CHUNK_SIZE = 64 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Logins can run on several threads at once, only one of them may talk to the terminal at a time
+prompt_lock = RLock()
+
+
+def ask(prompt: str, secret: bool = False) -> str:
+    if console.installed and current_thread() is not main_thread():
+        # The shell owns the terminal while it waits for commands, it asks on behalf of background work
+        return console.request_input(prompt, secret, checkpoint)
+    with prompt_lock:
+        return getpass(prompt) if secret else input(prompt)
+
 
 class LoginState(Enum):
     Offline = 'offline'
@@ -18,31 +53,104 @@ class LoginState(Enum):
     LoginToken = 'lt'
 
 
+def freeze(value):
+    if isinstance(value, dict):
+        return Subconfig(value)
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
 class Subconfig:
-    def __init__(self, data):
-        self._data = data
+    # Read-only config section. Every key lives in a slot of a subclass made for the section's set of keys,
+    # so reading a value is a plain attribute lookup.
+    __slots__ = ('_data',)
+    _section_classes = {}
+
+    def __new__(cls, data: dict):
+        names = tuple(key for key in data if isinstance(key, str) and key.isidentifier() and not hasattr(cls, key))
+        section_class = cls._section_classes.get((cls, names))
+        if not section_class:
+            section_class = type(cls.__name__, (cls,), {'__slots__': names})
+            cls._section_classes[cls, names] = section_class
+        return object.__new__(section_class)
+
+    def __init__(self, data: dict):
+        frozen = {key: freeze(value) for key, value in data.items()}
+        object.__setattr__(self, '_data', MappingProxyType(frozen))
+        for key in type(self).__slots__:
+            object.__setattr__(self, key, frozen[key])
+
+    def __setattr__(self, key, value):
+        raise AttributeError('The configuration is read-only')
 
     def __getitem__(self, key):
-        val = self._data[key]
-        if isinstance(val, dict):
-            return Subconfig(self._data[key])
-        return val
+        return self._data[key]
 
     def __getattr__(self, item):
         return self[item]
 
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def as_dict(self) -> dict:
+        return dict(self._data)
+
 
 class Config(Subconfig):
-    _singleton = None
+    """Parsed config.yaml. Calling Config() returns the current tree, reparsing only after the file changes."""
+
+    __slots__ = ('mtime',)
+
+    path = 'config.yaml'
+    check_interval = 1.0
+
+    _current = None
+    _checked = 0.0
+    _failed_mtime = None
+    _lock = RLock()
 
-    def __new__(cls, *args, **kwargs):
-        if not cls._singleton:
-            cls._singleton = super().__new__(cls, *args, **kwargs)
-        return cls._singleton
+    def __new__(cls):
+        now = time.monotonic()
+        if cls._current is not None and now - cls._checked < cls.check_interval:
+            return cls._current
+
+        with cls._lock:
+            cls._checked = now
+            try:
+                mtime = os.stat(cls.path).st_mtime_ns
+            except OSError:
+                if cls._current is None:
+                    raise
+                return cls._current
+
+            if cls._current is None:
+                cls._current = cls.load(mtime)
+            elif mtime != cls._current.mtime and mtime != cls._failed_mtime:
+                try:
+                    cls._current = cls.load(mtime)
+                    print('Reloaded the configuration')
+                except (OSError, ValueError, yaml.YAMLError) as e:
+                    cls._failed_mtime = mtime
+                    print(f'Not reloading the configuration, {cls.path} is invalid: {e}')
+            return cls._current
 
     def __init__(self):
-        with open('config.yaml', 'r') as f:
-            super().__init__(yaml.safe_load(f))
+        pass
+
+    @classmethod
+    def load(cls, mtime: int) -> 'Config':
+        with open(cls.path, 'r') as f:
+            data = yaml.safe_load(f)
+        validate(data, CONFIG_SCHEMA)
+
+        config = Subconfig.__new__(cls, data)
+        Subconfig.__init__(config, data)
+        object.__setattr__(config, 'mtime', mtime)
+        return config
 
 
 class Handler(abc.ABC):
@@ -60,11 +168,21 @@ class Handler(abc.ABC):
     def launch(self, file_path: str, env: dict = None, cwd: str = None, **kwargs) -> None:
         pass
 
+    def popen(self, command: List[str], resources: ResourcePolicy = None, **kwargs):
+        if resources:
+            command = resources.wrap_command(command)
+        self.app = subprocess.Popen(command, **kwargs)
+        if resources:
+            resources.attach(self.app.pid)
+
 
 class Game(abc.ABC):
     state = LoginState.Offline
     handler = None
+    updater = None
     path = None
+    # Set while a client waits for its turn in a launch group
+    starting = False
     username = password = None
 
     def __init__(self, game_name, account):
@@ -86,9 +204,11 @@ class Game(abc.ABC):
 
     def process_step(self, **kwargs):
         data = None
-        for i in range(10):
+        for i in range(Config().Login.max_steps):
+            checkpoint()
             func = getattr(self, f'process_{self.state.value}')
-            self.state, data = func() if self.state == LoginState.Offline else func(data, **kwargs)
+            with tracer.span(f'login.{self.state.value}', game=self.account['game']):
+                self.state, data = func() if self.state == LoginState.Offline else func(data, **kwargs)
             tl = self.try_launch(data, **kwargs)
             if tl is not None:
                 return tl
@@ -96,7 +216,8 @@ class Game(abc.ABC):
 
     def try_launch(self, data, **kwargs) -> Optional[bool]:
         if self.state == LoginState.Online:
-            self.start_game(data, **kwargs)
+            with tracer.span('login.start_game', game=self.account['game']):
+                self.start_game(data, **kwargs)
             return True
         elif not data:
             return False
@@ -117,12 +238,68 @@ class Game(abc.ABC):
         return self.state == LoginState.Online
 
     def is_active(self) -> bool:
+        if self.starting:
+            return True
         return self.is_playable() and self.handler.app and self.handler.app.poll() is None
 
-    def launch(self, env: dict = None, **kwargs):
-        self.handler.launch(self.path, env, cwd=self.game_directory, **kwargs)
+    def log_name(self) -> str:
+        return f'{self.account["game"]}-{self.account["login"]}'
+
+    def resource_policy(self) -> ResourcePolicy:
+        # Account settings from accounts.yaml override the per-game ones from config.yaml
+        settings = Config().Resources
+        options = self.config.resources.as_dict() if 'resources' in self.config else {}
+        options.update(self.account.get('resources', {}))
+        if 'cpus' not in options and settings.spread:
+            options['cpus'] = core_allocator.allocate(settings.cores_per_client, parse_cpus(settings.reserved_cores))
+        return ResourcePolicy(self.log_name(), cgroup_root=os.path.expanduser(settings.cgroup_root), **options)
+
+    def launch(self, env: dict = None, gate: LaunchGate = None, **kwargs):
+        if gate is None:
+            self.start_client(env, **kwargs)
+            return
+
+        if current_job() is None:
+            # A queued login finishing on the scheduler thread, which must not wait for this client's turn
+            self.starting = True
+            gate.defer(self.account['display_name'], self.start_in_turn, env, gate, kwargs)
+            return
+        self.start_in_turn(env, gate, kwargs)
 
-    def update(self, force: bool = False):
+    def start_in_turn(self, env: dict, gate: LaunchGate, kwargs: dict):
+        # Logins of a launch group run in parallel, the clients start one after another
+        try:
+            with gate.turn(self.account['display_name']):
+                self.start_client(env, **kwargs)
+                gate.launched(self.handler.app)
+        finally:
+            self.starting = False
+
+    def start_client(self, env: dict = None, **kwargs):
+        resources = self.resource_policy()
+        try:
+            self.handler.launch(self.path, env, cwd=self.game_directory, resources=resources,
+                                client_name=self.account['display_name'], **kwargs)
+        except BaseException:
+            if resources.cpus:
+                core_allocator.release(resources.cpus)
+            raise
+        if resources.cpus:
+            core_allocator.register(resources.cpus, self.handler.app)
+        output_drainer.attach(self.log_name(), self.handler.app)
+
+    def update(self, force: bool = False, verify: bool = False):
+        pass
+
+    def stage_update(self, force: bool = False) -> bool:
+        return bool(self.updater) and self.updater.stage(force)
+
+    def apply_staged_update(self) -> bool:
+        return bool(self.updater) and self.updater.has_staged() and self.updater.apply_staged()
+
+    @classmethod
+    def prepare(cls):
+        """Called once when the shell starts, before any account is launched."""
         pass
 
     def stop(self):
@@ -130,9 +307,87 @@ class Game(abc.ABC):
         self.handler.app = None
 
 
+class CorruptArchiveError(OSError):
+    pass
+
+
+class StreamDecompressor:
+    def __init__(self, algo: str):
+        if algo not in ('bzip2', 'gzip'):
+            raise ValueError(f'Unknown compression algorithm {algo}')
+        self.algo = algo
+        self.decompressor = self.new_decompressor()
+
+    def new_decompressor(self):
+        if self.algo == 'bzip2':
+            return bz2.BZ2Decompressor()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    @property
+    def eof(self) -> bool:
+        return self.decompressor.eof
+
+    def decompress(self, data: bytes) -> bytes:
+        try:
+            return self.decompressor.decompress(data, CHUNK_SIZE)
+        except (OSError, zlib.error) as e:
+            raise CorruptArchiveError(e)
+
+    def has_pending_output(self) -> bool:
+        if self.decompressor.eof:
+            return False
+        if self.algo == 'bzip2':
+            return not self.decompressor.needs_input
+        return bool(self.decompressor.unconsumed_tail)
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        # Output is produced in CHUNK_SIZE pieces so a highly compressed chunk can not blow up memory
+        while data:
+            yield self.decompress(data)
+            while self.has_pending_output():
+                pending = self.decompressor.unconsumed_tail if self.algo == 'gzip' else b''
+                yield self.decompress(pending)
+
+            # Archives may consist of several concatenated streams
+            data = self.decompressor.unused_data if self.decompressor.eof else b''
+            if data:
+                self.decompressor = self.new_decompressor()
+
+
+class ArchiveStream:
+    """Decompresses an archive into output while hashing both the archive and its contents."""
+
+    def __init__(self, output: BinaryIO, algo: str):
+        self.output = output
+        self.algo = algo
+        self.reset()
+
+    def reset(self):
+        self.output.seek(0)
+        self.output.truncate()
+        self.archive_sha1 = hashlib.sha1()
+        self.file_sha1 = hashlib.sha1()
+        self.decompressor = StreamDecompressor(self.algo)
+
+    def feed(self, chunk: bytes):
+        self.archive_sha1.update(chunk)
+        for data in self.decompressor.feed(chunk):
+            self.file_sha1.update(data)
+            self.output.write(data)
+
+    def check(self, url: str, archive_hash: str, file_hash: str):
+        if self.archive_sha1.hexdigest() != archive_hash:
+            raise CorruptArchiveError(f'File hash mismatch: expected {archive_hash}, '
+                                      f'got {self.archive_sha1.hexdigest()}')
+        if not self.decompressor.eof:
+            raise OSError(f'Archive from {url} is truncated')
+        if self.file_sha1.hexdigest() != file_hash:
+            raise CorruptArchiveError(f'File hash mismatch: expected {file_hash}, got {self.file_sha1.hexdigest()}')
+
+
 class UpdaterFile:
     def __init__(self, path: str, filename: str, file_hash: str, archive_hash: str,
-                 network_path: str, hash_url: bool = False, algo: str = 'gzip'):
+                 network_path: str, hash_url: bool = False, algo: str = 'gzip', patches: dict = None):
         self.path = path
         self.filename = filename
         self.file_hash = file_hash
@@ -140,45 +395,148 @@ class UpdaterFile:
         self.network_path = network_path
         self.hash_url = hash_url
         self.algo = algo
+        # Maps the hash of an older version of the file to the delta patch that upgrades it
+        self.patches = patches or {}
 
 
 class Updater(abc.ABC):
     manifest_files = []
     update_url = ''
     updater_name = ''
+    # Downloaded before everything else so a launch never waits behind resource packs
+    executables = []
 
     patch_manifest: List[UpdaterFile]
 
-    def __init__(self, game_dir: str):
+    def __init__(self, game_dir: str, session: requests.Session):
         self.game_directory = game_dir + os.path.sep
+        self.session = session
+        self.state_directory = self.game_directory + '.toonylinux' + os.path.sep
+        # Has to be on the same filesystem as the game so staged files can be renamed into place
+        self.staging_directory = self.state_directory + 'staging' + os.path.sep
+        self.staged_manifest = self.state_directory + 'staged.json'
         self.patch_manifest = []
+        self.manifest_changed = False
         self.files_needed = []
+        self.local_hashes = {}
+        self.hash_cache = HashCache(self.state_directory + 'hashes.json')
+        self.journal = DownloadJournal(self.state_directory + 'journal.jsonl')
+        settings = Config().BlobStore
+        self.blob_store = BlobStore(settings.directory, settings.link) if settings.enabled else None
+        self.bandwidth_limiters = [bandwidth_limiter]
+        # Cancel event of the job running the update, download workers are not jobs themselves
+        self.cancel_event: Optional[Event] = None
 
     @abc.abstractmethod
-    def get_partial_manifest(self, path: str):
+    def parse_manifest(self, path: str, manifest: dict) -> List[UpdaterFile]:
         pass
 
+    def get_partial_manifest(self, path: str):
+        cache_path = self.state_directory + 'manifests' + os.path.sep + self.sha1_hash_path(path) + '.json'
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = None
+
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        manifest = self.session.get(path, headers=headers)
+        if manifest.status_code == 304 and cached:
+            self.patch_manifest.extend(UpdaterFile(**file) for file in cached['files'])
+            return
+
+        if manifest.status_code != 200:
+            raise ConnectionError(manifest.status_code)
+
+        files = self.parse_manifest(path, json.loads(manifest.text))
+        self.manifest_changed = True
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        atomic_write(cache_path, json.dumps(dict(
+            etag=manifest.headers.get('ETag'), last_modified=manifest.headers.get('Last-Modified'),
+            files=[vars(file) for file in files])))
+        self.patch_manifest.extend(files)
+
     def get_patch_manifest(self):
+        self.manifest_changed = False
         for manifest_file in self.manifest_files:
             self.get_partial_manifest(manifest_file)
 
-    def check_local_files(self, force: bool = False, debug: bool = False):
+    def cached_files_match(self) -> bool:
+        """Checks the manifest against the hash cache only, without reading any file contents."""
+        for file in self.patch_manifest:
+            try:
+                stat = os.stat(self.game_directory + file.path)
+            except FileNotFoundError:
+                return False
+            if self.hash_cache.get(file.path, stat) != file.file_hash:
+                return False
+        return True
+
+    def check_local_files(self, force: bool = False, debug: bool = False, verify: bool = False):
+        local_hashes = {}
+        to_hash = []
         for file in self.patch_manifest:
             full_path = self.game_directory + file.path
 
-            if os.path.exists(full_path):
-                file_hash = self.sha1_hash_file(full_path)
+            try:
+                stat = os.stat(full_path)
+            except FileNotFoundError:
+                self.hash_cache.discard(file.path)
+                continue
+
+            file_hash = None if verify else self.hash_cache.get(file.path, stat)
+            if file_hash is None:
+                to_hash.append((file, full_path, stat))
+            else:
+                local_hashes[file.path] = file_hash
 
-                if file_hash == file.file_hash and not force:
-                    continue
+        local_hashes.update(self.hash_local_files(to_hash, debug))
+        self.local_hashes = local_hashes
+
+        for file in self.patch_manifest:
+            if local_hashes.get(file.path) == file.file_hash and not force:
+                continue
 
             if debug:
                 print(f'File "{file.filename}" at "{file.path}" needs updating. Queuing.')
             self.files_needed.append(file)
 
+        self.hash_cache.save()
+
+    def hash_local_files(self, files: List[Tuple[UpdaterFile, str, os.stat_result]], debug: bool = False) -> dict:
+        if not files:
+            return {}
+
+        # Largest files first so a big file does not end up as the only job left at the end
+        files = sorted(files, key=lambda item: item[2].st_size, reverse=True)
+        workers = int(Config().Updater.hash_workers) or os.cpu_count() or 1
+        started = time.monotonic()
+
+        hashes = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.sha1_hash_file, full_path, HASH_CHUNK_SIZE): (file, stat)
+                       for file, full_path, stat in files}
+            for future in as_completed(futures):
+                file, stat = futures[future]
+                hashes[file.path] = future.result()
+                self.hash_cache.update(file.path, stat, hashes[file.path])
+
+        if debug:
+            elapsed = max(time.monotonic() - started, 1e-6)
+            total_mb = sum(stat.st_size for _, _, stat in files) / 1024 / 1024
+            print(f'Hashed {len(files)} files ({total_mb:.1f} MB) in {elapsed:.2f}s, '
+                  f'{total_mb / elapsed:.1f} MB/s on {workers} workers')
+        return hashes
+
     def is_updated(self) -> bool:
         self.get_patch_manifest()
-        self.check_local_files(True)
+        if self.manifest_changed or not self.cached_files_match():
+            self.check_local_files()
 
         value = not self.files_needed
 
@@ -188,11 +546,12 @@ class Updater(abc.ABC):
         return value
 
     @staticmethod
-    def sha1_hash_file(file_path) -> str:
+    def sha1_hash_file(file_path, chunk_size: int = 8192) -> str:
         if os.path.exists(file_path):
             with open(file_path, 'rb') as f:
+                # hashlib releases the GIL on large buffers, so hashing threads use separate cores
                 file_hash = hashlib.sha1()
-                while chunk := f.read(8192):
+                while chunk := f.read(chunk_size):
                     file_hash.update(chunk)
 
             return file_hash.hexdigest()
@@ -208,92 +567,316 @@ class Updater(abc.ABC):
         return self.sha1_hash_file(path) == file_hash
 
     @staticmethod
-    def decompress_file(archive: str, local_file: str, algo: str):
-        with open(archive, 'rb') as b:
-            with open(local_file, 'wb') as lf:
-                if algo == 'bzip2':
-                    lf.write(bz2.decompress(b.read()))
-                elif algo == 'gzip':
-                    lf.write(gzip.decompress(b.read()))
-
-    def extract(self, download_path: str, extraction_path: str, algo: str) -> int:
-        try:
-            self.decompress_file(download_path, extraction_path, algo)
-            return 0
-        except OSError:
-            os.remove(extraction_path)
-            return -1
-        finally:
-            os.remove(download_path)
-
-    @staticmethod
-    def download(url: str, filepath: str) -> int:
+    def partial_path(filepath: str, archive_hash: str) -> str:
+        # Named after the archive, so a transfer left over from an older release is never resumed
+        return f'{filepath}.{archive_hash}.part'
+
+    def download(self, url: str, filepath: str, archive_hash: str, file_hash: str, algo: str):
+        # The compressed bytes are kept in a .part file so an interrupted transfer can be resumed
+        # with a Range request. Everything else happens in a single streaming pass.
+        partial_path = self.partial_path(filepath, archive_hash)
+        for stale in glob.glob(glob.escape(filepath) + '.*.part'):
+            if stale != partial_path:
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+
+        resumed = os.path.isfile(partial_path) and os.path.getsize(partial_path) > 0
         try:
-            response = requests.get(url)
-            stream = response.content
-            if response.status_code != 200:
-                print(f"Invalid response code: {response.status_code} from URL {url}")
-                return -1
-
-            with open(filepath, 'wb') as f:
-                f.write(stream)
-
-            return 0
-        except (OSError, ConnectionError) as e:
-            print(e)
-            return -1
+            self.fetch(url, filepath, partial_path, archive_hash, file_hash, algo)
+        except CorruptArchiveError:
+            if not resumed:
+                raise
+            # The kept bytes do not belong to this archive, fetch all of it once more
+            os.remove(partial_path)
+            self.fetch(url, filepath, partial_path, archive_hash, file_hash, algo)
+
+        os.remove(partial_path)
+
+    def fetch(self, url: str, filepath: str, partial_path: str, archive_hash: str, file_hash: str, algo: str):
+        with open(filepath, 'wb') as output, open(partial_path, 'ab+') as archive:
+            stream = ArchiveStream(output, algo)
+
+            archive.seek(0)
+            while chunk := archive.read(CHUNK_SIZE):
+                stream.feed(chunk)
+
+            resume_from = archive.tell()
+            headers = {'Range': f'bytes={resume_from}-'} if resume_from else {}
+            with self.session.get(url, stream=True, headers=headers) as response:
+                if response.status_code == 200 and resume_from:
+                    # The server ignored the Range header, start over
+                    archive.truncate(0)
+                    stream.reset()
+                elif response.status_code == 416 and resume_from:
+                    # The previous attempt already fetched the whole archive
+                    pass
+                elif response.status_code not in (200, 206):
+                    raise OSError(f'Invalid response code: {response.status_code} from URL {url}')
+
+                if response.status_code != 416:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        if self.cancel_event and self.cancel_event.is_set():
+                            # The .part file keeps what arrived so far for the next attempt
+                            raise JobCancelled(f'Download of {url} cancelled')
+                        for limiter in self.bandwidth_limiters:
+                            limiter.consume(len(chunk))
+                        archive.write(chunk)
+                        stream.feed(chunk)
+
+            stream.check(url, archive_hash, file_hash)
+
+    def get_file_target(self, file: UpdaterFile) -> str:
+        return self.sha1_hash_path(file.network_path) if file.hash_url else file.network_path
 
     def acquire_file(self, file: UpdaterFile):
-        file_target = self.sha1_hash_path(file.network_path) if file.hash_url else file.network_path
+        file_target = self.get_file_target(file)
 
         url = self.update_url + file_target
-        download_path = self.game_directory + file_target
-        extracted_path = download_path + '~'
+        extracted_path = self.staging_directory + file_target + '~'
 
-        state = self.download(url, download_path)
-        if state != 0:
-            try:
-                os.remove(download_path)
-            except FileNotFoundError:
-                pass
-            raise OSError
+        if self.journal.is_staged(file.path, file.file_hash, extracted_path):
+            file.filename = file_target + '~'
+            return
 
-        if not self.verify(download_path, file.archive_hash):
-            raise OSError(f'File hash mismatch: expected {file.archive_hash}, '
-                          f'got {self.sha1_hash_file(download_path)}')
+        if self.blob_store and self.blob_store.materialise(file.file_hash, extracted_path):
+            # Another installation on this host already downloaded the file
+            file.filename = file_target + '~'
+            self.journal.record(file.path, file.file_hash, extracted_path)
+            return
+
+        try:
+            self.download(url, extracted_path, file.archive_hash, file.file_hash, file.algo)
+        except OSError as e:
+            to_remove = [extracted_path]
+            if isinstance(e, CorruptArchiveError):
+                to_remove.append(self.partial_path(extracted_path, file.archive_hash))
+            for path in to_remove:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            raise
+
+        file.filename = file_target + '~'
+        self.journal.record(file.path, file.file_hash, extracted_path)
+
+    def scheduled_acquire_file(self, file: UpdaterFile, priority: int, counter: TransferCounter) -> int:
+        """Returns the number of bytes that were transferred for the file."""
+        with ExitStack() as stack:
+            for limiter in self.bandwidth_limiters:
+                stack.enter_context(limiter.transfer(priority))
+            with tracer.span('update.acquire', updater=self.updater_name):
+                self.acquire_file(file)
+            return counter.current()
+
+    def expected_size(self, file: UpdaterFile) -> Optional[int]:
+        # Manifests do not list sizes, the file being replaced is the best guess there is
+        try:
+            return os.stat(self.game_directory + file.path).st_size
+        except FileNotFoundError:
+            return None
 
-        if self.extract(download_path, extracted_path, file.algo) != 0:
-            raise OSError
+    def download_priority(self, file: UpdaterFile, size: Optional[int]) -> Tuple[int, float]:
+        if os.path.basename(file.path) in self.executables:
+            return 0, 0
+        if size is not None and size <= Config().Updater.small_file_size:
+            return 1, size
+        return 2, size if size is not None else float('inf')
 
-        if self.verify(extracted_path, file.file_hash):
-            file.filename = file_target + '~'
+    @staticmethod
+    def format_eta(seconds: float) -> str:
+        minutes, seconds = divmod(int(seconds), 60)
+        return f'{minutes}m{seconds:02d}s' if minutes else f'{seconds}s'
+
+    @contextmanager
+    def counting(self, counter: TransferCounter):
+        # The download loop passes every chunk through the limiters, so the counter sees them the same way
+        self.bandwidth_limiters.append(counter)
+        try:
+            yield
+        finally:
+            self.bandwidth_limiters.remove(counter)
+
+    @staticmethod
+    def estimate_eta(remaining: float, finished_transferred: int, finished_size: int, transferred: int,
+                     elapsed: float) -> Optional[float]:
+        """Seconds until remaining bytes of extracted files have arrived, None when there is nothing to go by.
+
+        The throughput counts every byte received so far, including those of files still in flight, so small
+        files finishing first do not skew it. Finished files tell how many compressed bytes an extracted
+        byte takes.
+        """
+        if not remaining or not transferred or elapsed <= 0:
+            return None
+        ratio = finished_transferred / finished_size if finished_transferred and finished_size else 1.0
+        in_flight = transferred - finished_transferred
+        return max(0.0, remaining * ratio - in_flight) / (transferred / elapsed)
+
+    def download_game_files(self, workers: int = None):
+        total = len(self.files_needed)
+        if not total:
             return
-        else:
-            raise OSError
 
-    def download_game_files(self):
-        for file in self.files_needed:
-            self.acquire_file(file)
-            print(f'Downloaded "{file.path}"')
+        workers = max(1, int(workers or Config().Updater.download_workers))
+        os.makedirs(self.staging_directory, exist_ok=True)
+
+        # The pool starts jobs in submission order, so sorting is all the scheduling that is needed
+        sizes = {file.path: self.expected_size(file) for file in self.files_needed}
+        known = [size for size in sizes.values() if size is not None]
+        average = sum(known) / len(known) if known else 0
+        estimates = {path: average if size is None else size for path, size in sizes.items()}
+        priorities = {file.path: self.download_priority(file, sizes[file.path]) for file in self.files_needed}
+        files = sorted(self.files_needed, key=lambda file: priorities[file.path])
+
+        remaining = sum(estimates.values())
+        # Compressed bytes that arrived for finished files, against the size of those files once extracted
+        finished_transferred = finished_size = 0
+        counter = TransferCounter()
+        job = current_job()
+        self.cancel_event = job.cancel_requested if job else None
+        started = time.monotonic()
+        errors = {}
+        done = 0
+        with self.counting(counter), ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.scheduled_acquire_file, file, priorities[file.path][0], counter): file
+                       for file in files}
+            pending = set(futures)
+            while pending:
+                finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                try:
+                    checkpoint()
+                except BaseException:
+                    # Files already being downloaded finish, their .part files make the next attempt resume
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+
+                for future in finished:
+                    file = futures[future]
+                    remaining -= estimates[file.path]
+                    try:
+                        transferred = future.result()
+                    except OSError as e:
+                        errors[file.path] = e
+                        print(f'Failed to download "{file.path}": {e}')
+                        continue
+
+                    done += 1
+                    finished_transferred += transferred
+                    finished_size += os.path.getsize(self.staging_directory + file.filename)
+                    eta_text = ''
+                    if done < total:
+                        eta = self.estimate_eta(remaining, finished_transferred, finished_size, counter.total,
+                                                time.monotonic() - started)
+                        if eta is None:
+                            # Without any local sizes to go by (a fresh install) the ETA is based on the file count
+                            eta = (total - done) * (time.monotonic() - started) / done
+                        eta_text = f', ETA {self.format_eta(eta)}'
+                    print(f'Downloaded "{file.path}" ({done}/{total}{eta_text})')
+
+        print(f'Downloaded {done} of {total} files, {len(errors)} failed')
+        if errors:
+            raise OSError('Could not download: ' + ', '.join(errors))
 
     def replace_game_files(self):
         for file in self.files_needed:
             local_path = self.game_directory + file.path
             local_dir = os.path.dirname(local_path)
             os.makedirs(local_dir, exist_ok=True)
-            os.replace(self.game_directory + file.filename, self.game_directory + file.path)
+            os.replace(self.staging_directory + file.filename, local_path)
+            # The staged file was verified against the manifest hash, no need to read it again
+            self.hash_cache.update(file.path, os.stat(local_path), file.file_hash)
+            self.journal.discard(file.path)
+        self.hash_cache.save()
+        self.journal.save()
+        self.patch_manifest.clear()
+        self.files_needed.clear()
+
+    def share_files(self, files: List[UpdaterFile]):
+        # Runs once every file matches the manifest, so installed files can go into the store as they are
+        if not self.blob_store:
+            return
+        for file in files:
+            self.blob_store.add(self.game_directory + file.path, file.file_hash)
+        self.blob_store.reference(self.game_directory, {file.path: file.file_hash for file in files})
+
+    def stage(self, force: bool = False) -> bool:
+        """Downloads the next update next to the running game, apply_staged() later swaps it in."""
+        print(f'{self.updater_name}: staging the next update in the background')
+        self.get_patch_manifest()
+        if not self.manifest_changed and not force and self.cached_files_match():
+            print(f'{self.updater_name}: local files match the patch manifest, nothing to stage')
+            self.patch_manifest.clear()
+            return False
+
+        self.check_local_files(force)
+        staging_limit = parse_rate(str(Config().Updater.staging_bandwidth_limit))
+        if staging_limit:
+            self.bandwidth_limiters.append(BandwidthLimiter(staging_limit))
+        self.download_game_files(int(Config().Updater.staging_workers))
+        staged = len(self.files_needed)
+        if staged:
+            atomic_write(self.staged_manifest, json.dumps([vars(file) for file in self.files_needed]))
         self.patch_manifest.clear()
         self.files_needed.clear()
+        print(f'{self.updater_name}: {staged} files staged, they are swapped in at the next launch')
+        return bool(staged)
 
-    def run(self, force: bool = False):
+    def has_staged(self) -> bool:
+        return os.path.exists(self.staged_manifest)
+
+    def apply_staged(self) -> bool:
+        try:
+            with open(self.staged_manifest, 'r') as f:
+                files = [UpdaterFile(**file) for file in json.load(f)]
+        except (OSError, ValueError):
+            return False
+
+        os.remove(self.staged_manifest)
+        missing = [file.path for file in files
+                   if not self.journal.is_staged(file.path, file.file_hash, self.staging_directory + file.filename)]
+        if missing:
+            # Something else touched the staged files, a regular update has to sort it out
+            print(f'{self.updater_name}: staged update is incomplete ({len(missing)} files), run update first')
+            return False
+
+        started = time.monotonic()
+        self.files_needed = list(files)
+        self.replace_game_files()
+        print(f'{self.updater_name}: swapped in {len(files)} staged files in {time.monotonic() - started:.2f}s')
+        return True
+
+    def run(self, force: bool = False, verify: bool = False):
         print('')
         print(self.updater_name)
         print('Fetching new patch manifest')
-        self.get_patch_manifest()
+        with tracer.span('update.manifest', updater=self.updater_name):
+            self.get_patch_manifest()
+        with tracer.span('update.cached_files_match', updater=self.updater_name):
+            unchanged = not self.manifest_changed and not force and not verify and self.cached_files_match()
+        manifest = list(self.patch_manifest)
+        if unchanged:
+            print('Patch manifest is unchanged and local files match it, nothing to update')
+            self.share_files(manifest)
+            self.patch_manifest.clear()
+            return
+
+        checkpoint()
         print('Checking local files for inconsistencies')
-        self.check_local_files(force, True)
+        with tracer.span('update.check_local_files', updater=self.updater_name):
+            self.check_local_files(force, True, verify)
         print('Downloading updated game files')
-        self.download_game_files()
+        with tracer.span('update.download', updater=self.updater_name):
+            self.download_game_files()
+        checkpoint()
         print('Patching local game files')
-        self.replace_game_files()
+        with tracer.span('update.replace_game_files', updater=self.updater_name):
+            self.replace_game_files()
+        try:
+            # The staged files were swapped in or replaced by this update
+            os.remove(self.staged_manifest)
+        except FileNotFoundError:
+            pass
+        self.share_files(manifest)
 
@@ -0,0 +1,130 @@
+import sys
+import threading
+from collections import deque
+from getpass import getpass
+from threading import Event, Lock
+from typing import Callable
+
+try:
+    import readline
+except ImportError:
+    readline = None
+
+
+class PromptRequest:
+    def __init__(self, prompt: str, secret: bool):
+        self.prompt = prompt
+        self.secret = secret
+        self.answer = None
+        self.done = Event()
+
+
+class ConsoleStream:
+    """Stands in for sys.stdout and hands every complete line to the console."""
+
+    def __init__(self, console: 'Console', stream):
+        self.console = console
+        self.stream = stream
+        self.partial = threading.local()
+
+    def write(self, text: str) -> int:
+        if threading.current_thread() is threading.main_thread():
+            self.stream.write(text)
+            return len(text)
+
+        # print() writes the text and the newline separately, lines are only emitted once complete
+        buffered = getattr(self.partial, 'text', '') + text
+        *lines, self.partial.text = buffered.split('\n')
+        if lines:
+            self.console.emit(lines)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Console:
+    """Keeps output of background jobs from garbling the shell prompt and collects their questions.
+
+    Background lines are printed above the prompt, which is then drawn again with whatever was typed so far.
+    Jobs can not read the terminal while the shell waits for a command, so ask() from a job thread queues a
+    request that the main thread answers once the user presses Enter on an empty line.
+    """
+
+    def __init__(self):
+        self.stream = None
+        self.prompt = ''
+        self.at_prompt = False
+        self.lock = Lock()
+        self.requests = deque()
+
+    @property
+    def installed(self) -> bool:
+        return self.stream is not None
+
+    def install(self, prompt: str):
+        if self.installed:
+            return
+        self.prompt = prompt
+        self.stream = sys.stdout
+        sys.stdout = ConsoleStream(self, self.stream)
+
+    def set_at_prompt(self, value: bool):
+        with self.lock:
+            self.at_prompt = value
+
+    def emit(self, lines):
+        with self.lock:
+            redraw = self.at_prompt and self.stream.isatty()
+            if redraw:
+                self.stream.write('\r\x1b[K')
+            for line in lines:
+                self.stream.write(line + '\n')
+            if redraw:
+                typed = readline.get_line_buffer() if readline else ''
+                self.stream.write(self.prompt + typed)
+            self.stream.flush()
+
+    def request_input(self, prompt: str, secret: bool, check: Callable[[], None] = None) -> str:
+        request = PromptRequest(prompt, secret)
+        with self.lock:
+            self.requests.append(request)
+        print(f'Input needed: "{prompt.strip()}", press Enter to answer')
+
+        while not request.done.wait(0.2):
+            if check:
+                try:
+                    check()
+                except BaseException:
+                    with self.lock:
+                        if request in self.requests:
+                            self.requests.remove(request)
+                    raise
+        return request.answer
+
+    def has_requests(self) -> bool:
+        with self.lock:
+            return bool(self.requests)
+
+    def serve_requests(self):
+        """Answers every queued question on the main thread."""
+        while True:
+            with self.lock:
+                if not self.requests:
+                    return
+                request = self.requests.popleft()
+            try:
+                request.answer = getpass(request.prompt) if request.secret else input(request.prompt)
+            except EOFError:
+                pass
+            finally:
+                # An interrupted question still has to release the job waiting for it
+                if request.answer is None:
+                    request.answer = ''
+                request.done.set()
+
+
+console = Console()
@@ -1,14 +1,15 @@
 import datetime
-import json
-from getpass import getpass
-import time
 import os
+from getpass import getuser
+from typing import List, Tuple, Any
 
-import requests
 from requests import JSONDecodeError
 
-from code.common import Game, LoginState, Updater, UpdaterFile
+from code.common import Config, Game, LoginState, Updater, UpdaterFile, ask
 from code.handler.windows_handler import WindowsHandler
+from code.ratelimit import EndpointLimiter, rate_limiter
+from code.scheduler import login_scheduler
+from code.session import get_session
 from code.shell import ToonLinuxShell
 
 
@@ -19,19 +20,25 @@ class CorporateClash(Game):
     force_account = ''
 
     def __init__(self, account):
-        username = os.getlogin()
+        username = getuser()
         path = f'users/{username}/AppData/Local/Corporate Clash'
         self.handler = WindowsHandler('CorporateClash.exe', path)
         self.token = None
+        self.attempts = 0
         super().__init__('CorporateClash', account)
-        self.updater = ClashPatcher(self.game_directory)
+        self.session = get_session('CorporateClash', self.get_headers())
+        self.updater = ClashPatcher(self.game_directory, self.session)
+
+    @classmethod
+    def prepare(cls):
+        WindowsHandler.prepare(os.path.expanduser(Config().Games.CorporateClash.prefix))
 
     @staticmethod
     def get_headers(**kwargs):
         return dict(kwargs, **{'user-agent': 'Toony Linux 0.2.1 by Wizzerinus'})
 
-    def update(self, force: bool = False):
-        self.updater.run(force)
+    def update(self, force: bool = False, verify: bool = False):
+        self.updater.run(force, verify)
 
     def login(self, login: str, token: str = '', toon_position: int = 6, **kwargs) -> bool:
         if toon_position != 6:
@@ -41,20 +48,42 @@ class CorporateClash(Game):
             kwargs['password'] = ''
         return super().login(login, **kwargs)
 
+    def rate_limited(self, limiter: EndpointLimiter, reason: str) -> Tuple[LoginState, Any]:
+        self.attempts += 1
+        if self.attempts >= Config().Login.max_attempts:
+            print(f'{reason}, giving up on {self.username} after {self.attempts} attempts.')
+            return LoginState.Rejected, False
+
+        delay = limiter.backoff()
+        print(f'{reason}, retrying {self.username} in {delay:.0f} seconds...')
+        return LoginState.Queue, delay
+
+    def process_queued(self, delay, **kwargs) -> Tuple[LoginState, Any]:
+        # The scheduler waits out the delay and retries from a login job, the shell and the other logins keep going
+        def retry_login():
+            self.state = LoginState.Offline
+            self.process_step(**kwargs)
+
+        login_scheduler.schedule(self, delay, retry_login, lambda: 'waiting for the login rate limit')
+        return LoginState.Queue, False
+
     def process_lt(self, ignored, **kwargs):
+        wait = rate_limiter.endpoint(self.config.token_api, self.config.rate_limit).try_acquire()
+        if wait > 0:
+            return LoginState.Queue, wait
+
         if 'password' in self.account:
             password = self.account['password']
             print('Using password from the old login configuration.')
         else:
-            password = getpass(f'You do not have a login token registered for username {self.username}. '
-                               f'Enter your password here: ')
+            password = ask(f'You do not have a login token registered for username {self.username}. '
+                           f'Enter your password here: ', secret=True)
         if not password:
             return LoginState.Rejected, False
 
         current_date = datetime.datetime.now().strftime('%Y-%m-%d')
         request = dict(username=self.username, password=password, friendly=f'Toony Linux {current_date}')
-        response = requests.post(
-            self.config.token_api, data=request, headers=self.get_headers()).json()
+        response = self.session.post(self.config.token_api, data=request).json()
 
         if not response['status']:
             if response.get('toonstep'):
@@ -72,15 +101,18 @@ class CorporateClash(Game):
     def process_offline(self):
         if not self.token:
             return LoginState.LoginToken, True
-        response = requests.post(
-            self.config.login_api, headers=self.get_headers(Authorization=f'Bearer {self.token}'))
+
+        limiter = rate_limiter.endpoint(self.config.login_api, self.config.rate_limit)
+        wait = limiter.try_acquire()
+        if wait > 0:
+            return LoginState.Queue, wait
+
+        response = self.session.post(self.config.login_api, headers={'Authorization': f'Bearer {self.token}'})
         try:
             response = response.json()
         except JSONDecodeError:
             if response.status_code == 429:
-                print('We are being rate limited, retrying in 15 seconds...')
-                time.sleep(15)
-                return LoginState.Offline, True
+                return self.rate_limited(limiter, 'We are being rate limited')
 
             # TODO: figure out what's the best way to do this
             if response.text.lower().startswith(CLOUDFLARE_CAPTCHA):
@@ -88,9 +120,7 @@ class CorporateClash(Game):
                 return LoginState.Offline, False
 
             print(response.text)
-            print('ISP consumed the JSON output, retrying in 5 seconds...')
-            time.sleep(5)
-            return LoginState.Offline, True
+            return self.rate_limited(limiter, 'ISP consumed the JSON output')
 
         if response.get('bad_token'):
             print('Your token has been revoked. Removing it from the configuration.')
@@ -99,6 +129,7 @@ class CorporateClash(Game):
             return LoginState.Rejected, False
 
         if response['status']:
+            limiter.success()
             return LoginState.Online, response['token']
 
         if response.get('toonstep'):
@@ -106,8 +137,7 @@ class CorporateClash(Game):
             return LoginState.Rejected, False
 
         if 'A lot of Toons' in response['message']:
-            print("We're rate limited, retrying...")
-            return LoginState.Offline, True
+            return self.rate_limited(limiter, "We're rate limited")
         print('Login failed:', response['message'])
         return LoginState.Rejected, False
 
@@ -123,8 +153,12 @@ class CorporateClash(Game):
             print('This account has no token!')
             return
 
-        response = requests.post(
-            self.config.login_api, headers=self.get_headers(Authorization=f'Bearer {token}')).json()
+        wait = rate_limiter.endpoint(self.config.login_api, self.config.rate_limit).try_acquire()
+        if wait > 0:
+            print(f'Rate limited, try again in {wait:.0f} seconds.')
+            return False
+
+        response = self.session.post(self.config.login_api, headers={'Authorization': f'Bearer {token}'}).json()
         if response.get('bad_token'):
             print('This token does not exist.')
             return False
@@ -144,15 +178,10 @@ class ClashPatcher(Updater):
     ]
 
     update_url = 'https://aws1.corporateclash.net/productionv2/'
+    executables = ['CorporateClash.exe']
 
-    def get_partial_manifest(self, path: str):
+    def parse_manifest(self, path: str, manifest: dict) -> List[UpdaterFile]:
         manifest_name = path.split('/')[-1]
-        manifest = requests.get(path)
-        if manifest.status_code != 200:
-            raise ConnectionError(manifest.status_code)
-
-        manifest = json.loads(manifest.text)
-        for file in manifest['files']:
-            self.patch_manifest.append(UpdaterFile(
-                filename=file['fileName'], path=file['filePath'].replace("\\", "/"), network_path=file['filePath'] + manifest_name,
-                file_hash=file['sha1'], archive_hash=file['compressed_sha1'], hash_url=True))
+        return [UpdaterFile(
+            filename=file['fileName'], path=file['filePath'].replace("\\", "/"), network_path=file['filePath'] + manifest_name,
+            file_hash=file['sha1'], archive_hash=file['compressed_sha1'], hash_url=True) for file in manifest['files']]
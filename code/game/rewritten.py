@@ -1,40 +1,49 @@
-import json
 import os
 import subprocess
-from threading import Timer
-from typing import Tuple, Any
+from typing import Tuple, Any, List
 
-import requests
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
 
-from code.common import Game, LoginState, Updater, UpdaterFile
+from code.common import Game, LoginState, Updater, UpdaterFile, CorruptArchiveError, HASH_CHUNK_SIZE, ask
 from code.handler.native_handler import NativeHandler
+from code.scheduler import login_scheduler
+from code.session import get_session
 from code.shell import ToonLinuxShell
 
 
 @ToonLinuxShell.game('rewritten')
 class ToontownRewritten(Game):
+    queue_position = 0
+    queue_token = None
+
     def __init__(self, account):
         self.handler = NativeHandler('TTREngine')
         super().__init__('ToontownRewritten', account)
-        self.updater = RewrittenUpdater(self.game_directory)
+        self.session = get_session('ToontownRewritten')
+        self.updater = RewrittenUpdater(self.game_directory, self.session)
 
     def process_offline(self) -> Tuple[LoginState, Any]:
         api_path = self.config.api_path
-        response = requests.post(api_path, data={'username': self.username, 'password': self.password}).json()
+        response = self.session.post(api_path, data={'username': self.username, 'password': self.password}).json()
         return self.get_login_state(response)
 
     def get_login_state(self, response: dict) -> Tuple[LoginState, Any]:
         if response['success'] == 'partial':
-            print('Two-partial authentication detected. Enter the authenticator token below.')
-            auth = input()
+            auth = ask(f'Two-partial authentication detected for {self.username}. '
+                       'Enter the authenticator token below.\n')
             if not auth:
                 print('Cancelling login attempt.')
                 return LoginState.Rejected, False
-            response = requests.post(self.config.api_path, data=dict(appToken=auth,
-                                                                     authToken=response['responseToken']))
+            response = self.session.post(self.config.api_path, data=dict(appToken=auth,
+                                                                         authToken=response['responseToken'])).json()
 
         if response['success'] == 'delayed':
-            print('Login delayed. You\'re at position', response['position'], 'relogging in 15 seconds.')
+            self.queue_position = int(response['position'])
+            print(f'Login for {self.username} delayed. You\'re at position {self.queue_position}, '
+                  f'checking again in {self.queue_interval():.0f} seconds.')
             return LoginState.Queue, response['queueToken']
 
         if response['success'] == 'true':
@@ -43,14 +52,25 @@ class ToontownRewritten(Game):
         print('Login failed:', response['banner'])
         return LoginState.Rejected, False
 
+    def queue_interval(self) -> float:
+        # Accounts near the front of the queue are polled often, the ones far behind rarely
+        interval = self.queue_position * self.config.queue_poll_factor
+        return min(self.config.queue_max_interval, max(self.config.queue_min_interval, interval))
+
     def process_queued(self, token, **kwargs) -> Tuple[LoginState, Any]:
-        def retry_login():
-            response = requests.post(self.config.api_path, data={'queueToken': token}).json()
+        self.queue_token = token
+
+        def poll_queue():
+            response = self.session.post(self.config.api_path, data={'queueToken': self.queue_token}).json()
             self.state, data = self.get_login_state(response)
+            if self.state == LoginState.Queue:
+                self.queue_token = data
+                return self.queue_interval()
             self.try_launch(data, **kwargs)
+            return None
 
-        timer = Timer(15, retry_login)
-        timer.start()
+        login_scheduler.schedule(self, self.queue_interval(), poll_queue,
+                                 lambda: f'queue position {self.queue_position}')
         return LoginState.Queue, False
 
     def start_game(self, data, **kwargs):
@@ -59,32 +79,74 @@ class ToontownRewritten(Game):
             TTR_PLAYCOOKIE=data['cookie'],
         ), **kwargs)
 
-    def update(self, force: bool = False):
-        self.updater.run(force)
+    def update(self, force: bool = False, verify: bool = False):
+        self.updater.run(force, verify)
 
 
 class RewrittenUpdater(Updater):
     updater_name = 'Toontown Rewritten Updater'
     manifest_files = ['https://cdn.toontownrewritten.com/content/patchmanifest.txt']
     update_url = 'https://download.toontownrewritten.com/patches/'
+    executables = ['TTREngine']
 
-    def get_partial_manifest(self, path: str):
-        manifest = requests.get(path)
-        if manifest.status_code != 200:
-            raise ConnectionError(manifest.status_code)
-
-        manifest = json.loads(manifest.text)
+    def parse_manifest(self, path: str, manifest: dict) -> List[UpdaterFile]:
+        files = []
         for filename, file in manifest.items():
             if 'linux2' not in file['only']:
                 print(f'Skipping {filename} because it is not for Linux.')
                 continue
 
-            self.patch_manifest.append(UpdaterFile(
+            files.append(UpdaterFile(
                 file_hash=file['hash'], archive_hash=file['compHash'], filename=filename, path=filename,
-                network_path=file['dl'], algo='bzip2'
+                network_path=file['dl'], algo='bzip2', patches=file.get('patches')
             ))
-
-    def run(self, force: bool = False):
-        super().run(force)
+        return files
+
+    def acquire_file(self, file: UpdaterFile):
+        staged_path = self.staging_directory + self.get_file_target(file) + '~'
+        patch = file.patches.get(self.local_hashes.get(file.path))
+        in_store = self.blob_store and self.blob_store.has(file.file_hash)
+        if patch and bsdiff4 and not in_store and not self.journal.is_staged(file.path, file.file_hash, staged_path):
+            try:
+                self.apply_patch(file, patch, staged_path)
+                return
+            except (OSError, ValueError) as e:
+                print(f'Could not patch "{file.path}" ({e}), downloading the full file')
+
+        super().acquire_file(file)
+
+    def apply_patch(self, file: UpdaterFile, patch: dict, staged_path: str):
+        patch_path = self.staging_directory + patch['filename'] + '~'
+        try:
+            self.download(self.update_url + patch['filename'], patch_path,
+                          patch['compPatchHash'], patch['patchHash'], 'bzip2')
+            bsdiff4.file_patch(self.game_directory + file.path, staged_path, patch_path)
+        finally:
+            # Failed patches fall back to the full download, so partial patches are not kept for resuming
+            for path in (patch_path, self.partial_path(patch_path, patch['compPatchHash'])):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        file_hash = self.sha1_hash_file(staged_path, HASH_CHUNK_SIZE)
+        if file_hash != file.file_hash:
+            os.remove(staged_path)
+            raise CorruptArchiveError(f'Patched file hash mismatch: expected {file.file_hash}, got {file_hash}')
+
+        file.filename = self.get_file_target(file) + '~'
+        self.journal.record(file.path, file.file_hash, staged_path)
+
+    def run(self, force: bool = False, verify: bool = False):
+        super().run(force, verify)
+        self.make_executable()
+
+    def apply_staged(self) -> bool:
+        applied = super().apply_staged()
+        if applied:
+            self.make_executable()
+        return applied
+
+    def make_executable(self):
         print('Adding execution privileges to the game executable')
         subprocess.run(['chmod', '+x', f'{self.game_directory}{os.sep}TTREngine'])
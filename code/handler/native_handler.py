@@ -8,7 +8,7 @@ class NativeHandler(Handler):
     def find(self, prefix: str) -> str:
         return os.path.join(prefix, self.filename)
 
-    def launch(self, path, env=None, cwd='', pipe_stderr=True, pipe_stdout=True, **kwargs):
+    def launch(self, path, env=None, cwd='', pipe_stderr=True, pipe_stdout=True, resources=None, **kwargs):
         env = env or {}
 
         args = dict(env=dict(os.environ, **env), cwd=cwd)
@@ -17,4 +17,4 @@ class NativeHandler(Handler):
         if pipe_stdout:
             args['stdout'] = subprocess.PIPE
 
-        self.app = subprocess.Popen([path], **args)
+        self.popen([path], resources, **args)
@@ -1,32 +1,116 @@
+import atexit
+import json
 import os
+import shutil
 import subprocess
+import time
 from glob import glob
+from threading import Lock, RLock, Thread
+from typing import List
 
+from code.cache import atomic_write
 from code.common import Config, Handler
 
 
+PRUNED_DIRECTORIES = {
+    'windows', 'windows nt', 'windows media player', 'windowspowershell', 'internet explorer', 'common files',
+    'microsoft', 'temp', 'inetcache', 'crashdumps', 'cache', 'shadercache',
+}
+
+
 class WindowsHandler(Handler):
+    path_index = None
+    prefix = None
+
     def find(self, prefix):
-        if self.force_path:
-            # Note that in this case we do not have to check the file's existance
-            # because the updater will download it
-            os.makedirs(f'{prefix}/drive_c/{self.force_path}', exist_ok=True)
-            return f'{prefix}/drive_c/{self.force_path}/{self.filename}'
-
-        subpaths = ['Program Files', 'Program Files (x86)', 'users/*/AppData']
-        for subpath in subpaths:
-            found = glob(f'{prefix}/drive_c/{subpath}/**/{self.filename}', recursive=True)
+        self.prefix = prefix
+        if not self.force_path:
+            found = self.lookup(prefix)
+            if not found:
+                raise ValueError('File not found')
+            if len(found) > 1:
+                raise ValueError(f'Multiple installations found: {found}')
+            return found[0]
+
+        fixed = f'{prefix}/drive_c/{self.force_path}/{self.filename}'
+        if os.path.isfile(fixed):
+            return fixed
+        # The game may have been installed somewhere else in the prefix, like with the game's own installer
+        found = self.lookup(prefix)
+        if len(found) == 1:
+            return found[0]
+        # Otherwise the updater downloads the game to the fixed path
+        os.makedirs(os.path.dirname(fixed), exist_ok=True)
+        return fixed
+
+    def lookup(self, prefix: str) -> List[str]:
+        key = f'{prefix}|{self.filename}'
+        index = self.load_index()
+        cached = index.get(key)
+        if cached and os.path.isfile(cached):
+            return [cached]
+
+        found = self.scan(prefix)
+        if len(found) == 1:
+            index[key] = found[0]
+            self.save_index(index)
+        return found
+
+    @classmethod
+    def load_index(cls) -> dict:
+        if cls.path_index is None:
+            try:
+                with open(os.path.expanduser(Config().Handlers.Windows.path_index), 'r') as f:
+                    cls.path_index = json.load(f)
+            except (OSError, ValueError):
+                cls.path_index = {}
+        return cls.path_index
+
+    @classmethod
+    def save_index(cls, index: dict):
+        path = os.path.expanduser(Config().Handlers.Windows.path_index)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        atomic_write(path, json.dumps(index))
+
+    def scan(self, prefix: str) -> List[str]:
+        root_groups = [
+            [f'{prefix}/drive_c/Program Files'],
+            [f'{prefix}/drive_c/Program Files (x86)'],
+            glob(f'{prefix}/drive_c/users/*/AppData'),
+        ]
+        for roots in root_groups:
+            found = [path for root in roots for path in self.walk(root)]
             if found:
-                if len(found) > 1:
-                    raise ValueError(f'Multiple installations found: {found}')
-                return found[0]
+                return found
+        return []
 
-        raise ValueError('File not found')
+    def walk(self, root: str) -> List[str]:
+        # Single scandir pass that does not follow the prefix's symlinks into $HOME
+        # and skips directories that never contain a game installation
+        found = []
+        stack = [root]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name.lower() not in PRUNED_DIRECTORIES:
+                            stack.append(entry.path)
+                    elif entry.name == self.filename:
+                        found.append(entry.path)
+        return found
 
-    def launch(self, path, env=None, cwd=None, pipe_stderr=True, pipe_stdout=True, **kwargs):
+    def launch(self, path, env=None, cwd=None, pipe_stderr=True, pipe_stdout=True, resources=None,
+               client_name=None, **kwargs):
         env = env or {}
+        settings = Config().Handlers.Windows
 
         args = dict(env=dict(os.environ, **env))
+        if self.prefix:
+            args['env']['WINEPREFIX'] = self.prefix
         if cwd is not None:
             args['cwd'] = cwd
         if pipe_stderr:
@@ -34,4 +118,125 @@ class WindowsHandler(Handler):
         if pipe_stdout:
             args['stdout'] = subprocess.PIPE
 
-        self.app = subprocess.Popen([Config().Handlers.Windows.wine_executable, path], **args)
+        if not settings.persistent_server or not self.prefix:
+            self.popen([settings.wine_executable, path], resources, **args)
+            return
+
+        server = WineServer.get(self.prefix)
+        server.start(launching=True)
+        started = time.monotonic()
+        self.app = None
+        try:
+            self.popen([settings.wine_executable, path], resources, **args)
+        finally:
+            server.track(self.app, client_name or path, started)
+
+    @staticmethod
+    def prepare(prefix: str):
+        if Config().Handlers.Windows.persistent_server:
+            WineServer.get(prefix).start()
+
+
+class WineServer:
+    """Persistent wineserver for one prefix, started before the first launch and let go after the last client.
+
+    The server is never killed, other Windows programs of the user may run in the same prefix. It lingers for
+    server_linger seconds after the last wine process of the prefix exits and then stops by itself.
+    """
+
+    servers = {}
+    servers_lock = Lock()
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.env = dict(os.environ, WINEPREFIX=prefix)
+        self.running = False
+        self.warm_process = None
+        self.clients = []
+        self.launching = 0
+        self.watcher = None
+        self.lock = RLock()
+
+    @classmethod
+    def get(cls, prefix: str) -> 'WineServer':
+        with cls.servers_lock:
+            if prefix not in cls.servers:
+                cls.servers[prefix] = cls(prefix)
+            return cls.servers[prefix]
+
+    def start(self, launching: bool = False):
+        settings = Config().Handlers.Windows
+        with self.lock:
+            if launching:
+                self.launching += 1
+            if self.running:
+                return
+            # -p keeps the server alive without clients, so the prefix is only booted once. If the server
+            # is already running this fails harmlessly and the running one is reused.
+            subprocess.run([settings.wineserver_executable, f'-p{settings.server_linger}'], env=self.env,
+                           stderr=subprocess.DEVNULL)
+            if settings.warm_process:
+                # An idle wine process keeps the prefix services and the common DLLs loaded
+                self.warm_process = subprocess.Popen(
+                    [settings.wine_executable, 'cmd.exe'], env=self.env, stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.running = True
+
+    def stop(self):
+        # Only lets go of what we started, the server exits on its own once its linger time is over
+        with self.lock:
+            if not self.running:
+                return
+            if self.warm_process:
+                self.warm_process.kill()
+                self.warm_process.wait()
+                self.warm_process = None
+            self.running = False
+
+    def track(self, app, name: str, started: float):
+        with self.lock:
+            self.launching -= 1
+            if app is None:
+                return
+            self.clients.append(app)
+            if not self.watcher:
+                self.watcher = Thread(target=self.watch, name=f'wineserver-{self.prefix}', daemon=True)
+                self.watcher.start()
+        Thread(target=self.report_window, args=(app, name, started), daemon=True).start()
+
+    def watch(self):
+        while True:
+            time.sleep(1)
+            with self.lock:
+                self.clients = [app for app in self.clients if app.poll() is None]
+                if self.clients or self.launching:
+                    continue
+                self.watcher = None
+                print(f'Last client of {self.prefix} exited, its wineserver stops once it is idle')
+                self.stop()
+                return
+
+    @staticmethod
+    def report_window(app, name: str, started: float):
+        xdotool = shutil.which('xdotool')
+        if not xdotool:
+            return
+
+        deadline = started + Config().Handlers.Windows.window_timeout
+        while time.monotonic() < deadline and app.poll() is None:
+            result = subprocess.run([xdotool, 'search', '--onlyvisible', '--pid', str(app.pid)],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            if result.stdout.strip():
+                print(f'{name}: window appeared {time.monotonic() - started:.1f}s after launch')
+                return
+            time.sleep(0.25)
+
+
+def stop_idle_servers():
+    for server in list(WineServer.servers.values()):
+        with server.lock:
+            if not server.launching and not any(app.poll() is None for app in server.clients):
+                server.stop()
+
+
+atexit.register(stop_idle_servers)
@@ -0,0 +1,144 @@
+import itertools
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+
+class JobCancelled(Exception):
+    pass
+
+
+_local = threading.local()
+
+
+def current_job() -> Optional['Job']:
+    return getattr(_local, 'job', None)
+
+
+def checkpoint():
+    """Raises JobCancelled when the job running on this thread was cancelled, does nothing outside of jobs."""
+    job = current_job()
+    if job and job.cancel_requested.is_set():
+        raise JobCancelled(f'Job {job.id} was cancelled')
+
+
+class Job:
+    def __init__(self, job_id: int, name: str, quiet: bool = False):
+        self.id = job_id
+        self.name = name
+        # Routine jobs are only reported and kept in the history when they fail
+        self.quiet = quiet
+        self.future = Future()
+        self.cancel_requested = threading.Event()
+        self.started = None
+        self.finished = None
+
+    @property
+    def state(self) -> str:
+        if not self.future.done():
+            return 'cancelling' if self.cancel_requested.is_set() else 'running' if self.started else 'pending'
+        if self.future.cancelled():
+            return 'cancelled'
+        error = self.future.exception()
+        if isinstance(error, JobCancelled):
+            return 'cancelled'
+        return 'failed' if error else 'done'
+
+    def elapsed(self) -> float:
+        if not self.started:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def wait(self, timeout: float = None) -> bool:
+        try:
+            self.future.exception(timeout)
+        except CancelledError:
+            pass
+        except FutureTimeout:
+            # Only the same class as the builtin from Python 3.11 on
+            return False
+        return True
+
+
+class JobManager:
+    """Runs long shell commands in the background.
+
+    Every pool is bounded, updates and logins use separate ones so logins never wait behind an update.
+    Dedicated jobs get a thread of their own, for low-priority staging and for jobs that only wait on others.
+    """
+
+    history = 50
+
+    def __init__(self, pools: Dict[str, int], on_finished: Callable[[Job], None] = None):
+        self.executors = {name: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-job')
+                          for name, workers in pools.items()}
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = Lock()
+        self.on_finished = on_finished
+
+    def submit(self, name: str, func: Callable, *args, pool: str = 'update', dedicated: bool = False,
+               quiet: bool = False, **kwargs) -> Job:
+        with self.lock:
+            job = Job(next(self.ids), name, quiet)
+            self.jobs[job.id] = job
+            self.prune()
+
+        if dedicated:
+            Thread(target=self.run, args=(job, func, args, kwargs), name=f'job-{job.id}', daemon=True).start()
+        else:
+            self.executors[pool].submit(self.run, job, func, args, kwargs)
+        return job
+
+    def run(self, job: Job, func: Callable, args: tuple, kwargs: dict):
+        if not job.future.set_running_or_notify_cancel():
+            return  # cancelled while it was waiting for a worker
+
+        _local.job = job
+        job.started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+        finally:
+            _local.job = None
+            self.finish(job)
+
+    def finish(self, job: Job):
+        job.finished = time.monotonic()
+        if job.quiet and job.state != 'failed':
+            with self.lock:
+                self.jobs.pop(job.id, None)
+            return
+        if self.on_finished:
+            self.on_finished(job)
+
+    def prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.future.done()]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def is_active(self, name: str) -> bool:
+        return any(job.name == name and not job.future.done() for job in self.list())
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.get(job_id)
+        if not job or job.future.done():
+            return False
+        job.cancel_requested.set()
+        if job.future.cancel():
+            # It never started, so nobody else reports it
+            self.finish(job)
+        return True
@@ -0,0 +1,129 @@
+import os
+import selectors
+from collections import deque
+from queue import SimpleQueue
+from threading import Lock, Thread
+from typing import List
+
+
+class ClientLog:
+    """Rotating log file plus an in-memory ring buffer with the last lines written by one client."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int, ring_lines: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lines = deque(maxlen=ring_lines)
+        self.partial = {}
+        self.lock = Lock()
+        self.file = None
+        self.size = 0
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, data: bytes, stream: str = 'stdout'):
+        if not self.file:
+            self.open()
+        if self.size + len(data) > self.max_bytes and self.size:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+        # stdout and stderr are split into lines separately so they do not end up in the middle of each other
+        *lines, self.partial[stream] = (self.partial.get(stream, b'') + data).split(b'\n')
+        with self.lock:
+            self.lines.extend(line.decode('utf-8', 'replace').rstrip('\r') for line in lines)
+
+    def tail(self, count: int = None) -> List[str]:
+        with self.lock:
+            lines = list(self.lines)
+        return lines[-count:] if count else lines
+
+
+class OutputDrainer:
+    """Reads the stdout and stderr of every launched client on a single thread.
+
+    Nothing else reads those pipes, so without this a chatty client blocks as soon as the pipe buffer is full.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.logs = {}
+        self.pending = SimpleQueue()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ, None)
+        self.thread = None
+        self.lock = Lock()
+
+        self.directory = 'logs'
+        self.max_bytes = 1024 * 1024
+        self.backups = 2
+        self.ring_lines = 200
+
+    def configure(self, directory: str, max_bytes: int, backups: int, ring_lines: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.ring_lines = ring_lines
+
+    def get_log(self, name: str) -> ClientLog:
+        with self.lock:
+            if name not in self.logs:
+                path = os.path.join(os.path.expanduser(self.directory), f'{name}.log')
+                self.logs[name] = ClientLog(path, self.max_bytes, self.backups, self.ring_lines)
+            return self.logs[name]
+
+    def attach(self, name: str, app):
+        log = self.get_log(name)
+        for stream, label in ((app.stdout, 'stdout'), (app.stderr, 'stderr')):
+            if stream is not None:
+                self.pending.put((stream, log, label))
+        os.write(self.wakeup_write, b'\0')
+
+        with self.lock:
+            if not self.thread:
+                self.thread = Thread(target=self.run, name='output-drainer', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    os.read(self.wakeup_read, 4096)
+                    while not self.pending.empty():
+                        stream, log, label = self.pending.get()
+                        os.set_blocking(stream.fileno(), False)
+                        self.selector.register(stream, selectors.EVENT_READ, (log, label))
+                    continue
+
+                try:
+                    data = os.read(key.fd, 65536)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''
+
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                log, label = key.data
+                log.write(data, label)
+
+
+output_drainer = OutputDrainer()
@@ -0,0 +1,79 @@
+import random
+import time
+from threading import Lock
+from typing import List, Tuple
+
+
+class EndpointLimiter:
+    """Token bucket with exponential backoff, shared by every account talking to one endpoint."""
+
+    def __init__(self, rate: float, burst: int, backoff: float, max_backoff: float):
+        self.rate = rate
+        self.burst = burst
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.failures = 0
+        self.lock = Lock()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        token_wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(token_wait, self.blocked_until - now)
+
+    def try_acquire(self) -> float:
+        """Takes a token and returns 0, or returns how long to wait without taking anything."""
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            wait = self.wait_time(now)
+            if wait <= 0:
+                self.tokens -= 1
+            return wait
+
+    def backoff(self) -> float:
+        """Registers a rejected request and returns the delay before the next attempt."""
+        with self.lock:
+            self.failures += 1
+            delay = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+            # Jitter keeps accounts that were rejected together from retrying together
+            delay = random.uniform(delay / 2, delay)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            return delay
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def status(self) -> Tuple[float, float, int]:
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            return self.tokens, max(0.0, self.wait_time(now)), self.failures
+
+
+class RateLimiter:
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = Lock()
+
+    def endpoint(self, url: str, config) -> EndpointLimiter:
+        with self.lock:
+            if url not in self.endpoints:
+                self.endpoints[url] = EndpointLimiter(
+                    config.rate, config.burst, config.backoff, config.max_backoff)
+            return self.endpoints[url]
+
+    def status(self) -> List[Tuple[str, float, float, int]]:
+        with self.lock:
+            endpoints = list(self.endpoints.items())
+        return [(url, *limiter.status()) for url, limiter in endpoints]
+
+
+rate_limiter = RateLimiter()
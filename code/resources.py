@@ -0,0 +1,167 @@
+import os
+import shutil
+import subprocess
+import threading
+from threading import Lock
+from typing import List, Optional, Set
+
+
+def parse_cpus(value) -> Set[int]:
+    """Accepts a list of core numbers or a cpuset string such as "0-3,6"."""
+    if isinstance(value, int):
+        return {value}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return set(int(cpu) for cpu in value)
+
+    cpus = set()
+    for part in str(value).split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        elif part.strip():
+            cpus.add(int(part))
+    return cpus
+
+
+def lower_thread_priority(nice: int):
+    """Moves the calling thread to the given nice level and idle I/O, threads it starts later inherit both."""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, nice)
+    except OSError:
+        pass  # already lower than that
+
+    ionice = shutil.which('ionice')
+    if ionice:
+        subprocess.run([ionice, '-c', '3', '-p', str(tid)], stderr=subprocess.DEVNULL)
+
+
+class ResourcePolicy:
+    def __init__(self, name: str, cpus=None, nice: int = None, ionice_class: int = None, ionice_level: int = None,
+                 cgroup: bool = False, cpu_weight: int = None, memory_max: str = None, cgroup_root: str = None):
+        self.name = name
+        self.cpus = parse_cpus(cpus) if cpus is not None else None
+        self.nice = nice
+        self.ionice_class = ionice_class
+        self.ionice_level = ionice_level
+        self.cgroup = cgroup
+        self.cpu_weight = cpu_weight
+        self.memory_max = memory_max
+        self.cgroup_root = cgroup_root
+        self.unapplied = set()
+
+    def wrap_command(self, command: List[str]) -> List[str]:
+        # Wrappers exec the client, so the pid stays the same and every thread it starts inherits the settings.
+        # preexec_fn would do the same without them, but is not safe in a process running other threads.
+        self.unapplied = set()
+        prefix = []
+        if self.cpus:
+            prefix += self.wrapper('taskset', 'cpus', ['-c', ','.join(map(str, sorted(self.cpus)))])
+        if self.nice:
+            prefix += self.wrapper('nice', 'nice', ['-n', str(self.nice)])
+        if self.ionice_class is not None or self.ionice_level is not None:
+            # Python has no ioprio_set. -t still runs the client when the class is refused, the realtime class 1
+            # needs CAP_SYS_ADMIN
+            options = ['-t', '-c', str(self.ionice_class if self.ionice_class is not None else 2)]
+            if self.ionice_level is not None:
+                options += ['-n', str(self.ionice_level)]
+            prefix += self.wrapper('ionice', None, options)
+        return prefix + command
+
+    def wrapper(self, name: str, setting: Optional[str], options: List[str]) -> List[str]:
+        path = shutil.which(name)
+        if path:
+            return [path] + options
+        if setting:
+            print(f'{name} is not installed, applying {setting} to the main thread of the client only')
+            self.unapplied.add(setting)
+        else:
+            print(f'{name} is not installed, ignoring the I/O priority settings')
+        return []
+
+    def cgroup_path(self) -> Optional[str]:
+        if not self.cgroup or not self.cgroup_root:
+            return None
+        name = self.cgroup if isinstance(self.cgroup, str) else self.name
+        return os.path.join(self.cgroup_root, name)
+
+    def attach(self, pid: int):
+        try:
+            if 'cpus' in self.unapplied:
+                os.sched_setaffinity(pid, self.cpus)
+            if 'nice' in self.unapplied:
+                os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+        except OSError as e:
+            print(f'Could not apply the CPU settings to the client: {e}')
+
+        path = self.cgroup_path()
+        if not path:
+            return
+
+        try:
+            os.makedirs(path, exist_ok=True)
+            try:
+                with open(os.path.join(self.cgroup_root, 'cgroup.subtree_control'), 'w') as f:
+                    f.write('+cpu +memory')
+            except OSError:
+                pass  # already enabled, or only some controllers are delegated to us
+            if self.cpu_weight is not None:
+                with open(os.path.join(path, 'cpu.weight'), 'w') as f:
+                    f.write(str(self.cpu_weight))
+            if self.memory_max is not None:
+                with open(os.path.join(path, 'memory.max'), 'w') as f:
+                    f.write(str(self.memory_max))
+            # cgroup v2 moves every thread of the process together
+            with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+                f.write(str(pid))
+        except OSError as e:
+            print(f'Could not move the client into cgroup {path}: {e}')
+
+
+class CoreAllocator:
+    """Gives every new client its own set of cores, reusing the least busy set once they run out.
+
+    A set counts as used from allocate() on, so clients launched at the same time spread out as well.
+    """
+
+    def __init__(self):
+        # (cores, app), app is None while the client is still starting
+        self.clients = []
+        self.lock = Lock()
+
+    @staticmethod
+    def core_sets(cores_per_client: int, reserved: Set[int]) -> List[Set[int]]:
+        cores = sorted(os.sched_getaffinity(0) - reserved) or sorted(os.sched_getaffinity(0))
+        cores_per_client = max(1, min(cores_per_client, len(cores)))
+        return [set(cores[i:i + cores_per_client]) for i in range(0, len(cores) - cores_per_client + 1,
+                                                                    cores_per_client)]
+
+    def allocate(self, cores_per_client: int, reserved: Set[int]) -> Set[int]:
+        with self.lock:
+            self.clients = [(cores, app) for cores, app in self.clients if app is None or app.poll() is None]
+            sets = self.core_sets(cores_per_client, reserved)
+            cores = min(sets, key=lambda cores: sum(1 for used, _ in self.clients if used == cores))
+            self.clients.append((cores, None))
+            return cores
+
+    def reservation(self, cores: Set[int]) -> Optional[int]:
+        return next((index for index, (used, app) in enumerate(self.clients) if app is None and used == cores),
+                    None)
+
+    def register(self, cores: Set[int], app):
+        with self.lock:
+            index = self.reservation(cores)
+            if index is None:
+                self.clients.append((cores, app))
+            else:
+                self.clients[index] = (cores, app)
+
+    def release(self, cores: Set[int]):
+        # The client did not start
+        with self.lock:
+            index = self.reservation(cores)
+            if index is not None:
+                del self.clients[index]
+
+
+core_allocator = CoreAllocator()
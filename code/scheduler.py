@@ -0,0 +1,126 @@
+import heapq
+import itertools
+import time
+from threading import Condition, Thread
+from traceback import print_exc
+from typing import Callable, Optional, List, Tuple
+
+from code.jobs import JobCancelled
+from code.tracing import tracer
+
+
+class ScheduledLogin:
+    def __init__(self, key: Tuple[str, str], game, step: Callable[[], Optional[float]], due: float,
+                 status: Callable[[], str]):
+        self.key = key
+        self.game = game
+        self.step = step
+        self.due = due
+        self.status = status
+        self.cancelled = False
+
+
+class LoginScheduler:
+    """Owns every login that has to be retried later (login queues, rate limits) and waits them out on one thread.
+
+    A step returns the number of seconds until it should run again, or None once the login is finished.
+    Due steps are handed to runner (the shell's login pool), so HTTP calls and questions to the user never
+    hold up the other logins. Without a runner they run on the scheduler thread.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = Condition()
+        self.thread = None
+        self.on_launch = None
+        self.runner: Optional[Callable[[str, Callable, ScheduledLogin], None]] = None
+
+    def schedule(self, game, delay: float, step: Callable[[], Optional[float]], status: Callable[[], str]):
+        key = (game.account['game'], game.account['login'])
+        with self.condition:
+            previous = self.entries.get(key)
+            if previous:
+                previous.cancelled = True
+
+            entry = ScheduledLogin(key, game, step, time.monotonic() + delay, status)
+            self.entries[key] = entry
+            heapq.heappush(self.heap, (entry.due, next(self.counter), entry))
+            self.condition.notify()
+
+            if not self.thread:
+                self.thread = Thread(target=self.run, name='login-scheduler', daemon=True)
+                self.thread.start()
+
+    def cancel(self, key: Tuple[str, str]) -> bool:
+        with self.condition:
+            entry = self.entries.pop(key, None)
+            if not entry:
+                return False
+            entry.cancelled = True
+            self.condition.notify()
+            return True
+
+    def pending(self) -> List[Tuple[Tuple[str, str], str, float]]:
+        now = time.monotonic()
+        with self.condition:
+            entries = list(self.entries.items())
+        return [(key, entry.status(), max(0.0, entry.due - now)) for key, entry in entries]
+
+    def next_entry(self) -> ScheduledLogin:
+        with self.condition:
+            while True:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                wait = self.heap[0][0] - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+
+                return heapq.heappop(self.heap)[2]
+
+    def run(self):
+        while True:
+            entry = self.next_entry()
+            if self.runner:
+                self.runner(f'login {entry.game.account["display_name"]}', self.run_step, entry)
+            else:
+                self.run_step(entry)
+
+    def run_step(self, entry: ScheduledLogin):
+        try:
+            with tracer.span('login.scheduled', game=entry.key[0]):
+                delay = entry.step()
+        except JobCancelled:
+            with self.condition:
+                if self.entries.get(entry.key) is entry:
+                    del self.entries[entry.key]
+            return
+        except Exception:
+            print_exc()
+            delay = None
+
+        with self.condition:
+            if entry.cancelled:
+                return
+            if delay is not None:
+                entry.due = time.monotonic() + delay
+                heapq.heappush(self.heap, (entry.due, next(self.counter), entry))
+                self.condition.notify()
+                return
+            del self.entries[entry.key]
+
+        # A failing callback must not take the thread down, every later login would hang
+        try:
+            if entry.game.is_playable() and self.on_launch:
+                self.on_launch(entry.game)
+        except Exception:
+            print_exc()
+
+
+login_scheduler = LoginScheduler()
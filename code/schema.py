@@ -0,0 +1,132 @@
+from typing import Any
+
+NUMBER = (int, float)
+
+# Keys starting with "?" are optional, "*" matches any key
+CONFIG_SCHEMA = {
+    'Games': {
+        'CorporateClash': {
+            'prefix': str,
+            'token_api': str,
+            'login_api': str,
+            'gameserver': str,
+            'rate_limit': {
+                'rate': NUMBER,
+                'burst': int,
+                'backoff': NUMBER,
+                'max_backoff': NUMBER,
+            },
+            '?network': dict,
+            '?resources': dict,
+        },
+        'ToontownRewritten': {
+            'prefix': str,
+            'api_path': str,
+            'queue_poll_factor': NUMBER,
+            'queue_min_interval': NUMBER,
+            'queue_max_interval': NUMBER,
+            '?network': dict,
+            '?resources': dict,
+        },
+    },
+    'GameData': {
+        '*': {
+            'uses_password': int,
+        },
+    },
+    'Handlers': {
+        'Windows': {
+            'wine_executable': str,
+            'path_index': str,
+            'wineserver_executable': str,
+            'persistent_server': int,
+            'warm_process': int,
+            'server_linger': int,
+            'window_timeout': NUMBER,
+        },
+    },
+    'Updater': {
+        'download_workers': int,
+        'hash_workers': int,
+        'staging_workers': int,
+        'staging_nice': int,
+        'bandwidth_limit': (str, int),
+        'staging_bandwidth_limit': (str, int),
+        'small_file_size': int,
+    },
+    'BlobStore': {
+        'enabled': int,
+        'directory': str,
+        'link': str,
+    },
+    'Network': {
+        'pool_size': int,
+        'timeout': NUMBER,
+        'retries': int,
+        'backoff': NUMBER,
+    },
+    'Login': {
+        'max_steps': int,
+        'max_attempts': int,
+    },
+    'Accounts': {
+        'journal_limit': int,
+    },
+    'Shell': {
+        'parallel_launch': int,
+        'job_workers': int,
+        'login_workers': int,
+    },
+    'Launch': {
+        'stagger': (str, int, float),
+        'settle_cpu': NUMBER,
+        'settle_io': int,
+        'settle_interval': NUMBER,
+        'settle_samples': int,
+        'settle_timeout': NUMBER,
+    },
+    'Logging': {
+        'clients': {
+            'directory': str,
+            'max_bytes': int,
+            'backups': int,
+            'ring_lines': int,
+        },
+        'summary_lines': int,
+    },
+    'Tracing': {
+        'enabled': int,
+        'window': int,
+        'jsonl': str,
+        'prometheus': str,
+        'prometheus_interval': NUMBER,
+    },
+    'Resources': {
+        'spread': int,
+        'cores_per_client': int,
+        'reserved_cores': list,
+        'cgroup_root': str,
+    },
+}
+
+
+def validate(data: Any, schema: Any, path: str = 'config'):
+    if not isinstance(schema, dict):
+        if not isinstance(data, schema):
+            raise ValueError(f'{path} has the wrong type: {type(data).__name__}')
+        return
+
+    if not isinstance(data, dict):
+        raise ValueError(f'{path} has to be a mapping')
+
+    for key, subschema in schema.items():
+        if key == '*':
+            for name, value in data.items():
+                validate(value, subschema, f'{path}.{name}')
+        elif key.startswith('?'):
+            if key[1:] in data:
+                validate(data[key[1:]], subschema, f'{path}.{key[1:]}')
+        elif key not in data:
+            raise ValueError(f'{path}.{key} is missing')
+        else:
+            validate(data[key], subschema, f'{path}.{key}')
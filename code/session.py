@@ -0,0 +1,62 @@
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from code.common import Config
+from code.tracing import tracer
+
+
+class PooledSession(requests.Session):
+    def __init__(self, timeout: float, headers: dict = None):
+        super().__init__()
+        self.timeout = timeout
+        if headers:
+            self.headers.update(headers)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if not tracer.enabled:
+            return super().request(method, url, **kwargs)
+
+        # Streamed responses are timed until the headers arrive, the body is part of the caller's span
+        with tracer.span('http', method=method, host=urlsplit(url).netloc) as span:
+            response = super().request(method, url, **kwargs)
+            span.labels['status'] = response.status_code
+            return response
+
+
+_sessions = {}
+_sessions_lock = Lock()
+
+
+def network_config(game_name: str) -> dict:
+    config = Config().Network.as_dict()
+    game_config = Config().Games[game_name]
+    if 'network' in game_config:
+        config.update(game_config.network.as_dict())
+    return config
+
+
+def make_session(game_name: str, headers: dict = None) -> PooledSession:
+    config = network_config(game_name)
+    retry = Retry(
+        total=config['retries'], backoff_factor=config['backoff'],
+        # 429 is left to the callers, the login servers use it to ask for longer delays
+        status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=config['pool_size'], pool_maxsize=config['pool_size'], max_retries=retry)
+
+    session = PooledSession(config['timeout'], headers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(game_name: str, headers: dict = None) -> PooledSession:
+    """Returns the keep-alive session shared by every login and update of the given game."""
+    with _sessions_lock:
+        if game_name not in _sessions:
+            _sessions[game_name] = make_session(game_name, headers)
+        return _sessions[game_name]
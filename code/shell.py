@@ -1,16 +1,29 @@
+import time
 from cmd import Cmd
-from getpass import getpass
-
-import yaml
-
-from code.common import Config
+from functools import partial
+from threading import Lock
+from traceback import format_exception
+
+from code.accounts import AccountStore
+from code.bandwidth import bandwidth_limiter, format_rate, parse_rate
+from code.blobstore import BlobStore
+from code.common import Config, LoginState, ask
+from code.console import console
+from code.jobs import JobManager, checkpoint
+from code.output import output_drainer
+from code.ratelimit import rate_limiter
+from code.resources import lower_thread_priority
+from code.scheduler import login_scheduler
+from code.stagger import LaunchGate
+from code.tracing import tracer
 
 
 class ToonLinuxShell(Cmd):
     accounts = None
     games = {}
-    launched_games = {}
     prompt = "ToonLinux> "
+    # The only account keys the logins take, everything else is read from game.account
+    login_keys = ('login', 'password', 'token', 'toon_position')
 
     value_replacements = {
         'true': True,
@@ -29,35 +42,46 @@ class ToonLinuxShell(Cmd):
 
     def __init__(self):
         super().__init__()
+        # Written from login jobs and the scheduler thread, read by shell commands
+        self.launched_games = {}
+        self.launched_lock = Lock()
+        self.jobs = JobManager(dict(update=Config().Shell.job_workers, login=Config().Shell.login_workers),
+                               self.report_job)
         self.load_toons()
+        login_scheduler.on_launch = self.finish_queued_login
+        login_scheduler.runner = partial(self.jobs.submit, pool='login', quiet=True)
+        clients = Config().Logging.clients
+        output_drainer.configure(clients.directory, clients.max_bytes, clients.backups, clients.ring_lines)
+        bandwidth_limiter.set_rate(parse_rate(str(Config().Updater.bandwidth_limit)))
+        tracing = Config().Tracing
+        tracer.configure(tracing.enabled, tracing.window, tracing.jsonl, tracing.prometheus,
+                         tracing.prometheus_interval)
+        for game in self.games.values():
+            game.prepare()
 
         self.do_lc = self.do_launch
         self.do_dc = self.do_disconnect
 
+    def preloop(self):
+        console.install(self.prompt)
+        console.set_at_prompt(True)
+
+    def precmd(self, line):
+        console.set_at_prompt(False)
+        return line
+
+    def postcmd(self, stop, line):
+        console.set_at_prompt(True)
+        return stop
+
     def emptyline(self):
-        pass
+        console.serve_requests()
 
     def load_toons(self):
-        with open('accounts.yaml', 'r') as f:
-            accounts = yaml.safe_load(f)
-
-            self.accounts = {}
-            for name, account in accounts.items():
-                self.accounts[name] = account
-                if account['game'] not in self.games:
-                    raise ValueError(f'Unknown game {account["game"]}')
-                if 'aliases' in account:
-                    for alias in account['aliases']:
-                        self.accounts[alias] = account
-
-    def save_accounts(self):
-        accounts = dict(self.accounts)
-        for login, account in self.accounts.items():
-            if login in account.get('aliases', []):
-                del accounts[login]
-
-        with open('accounts.yaml', 'w') as f:
-            yaml.dump(accounts, f)
+        if self.accounts is None:
+            self.accounts = AccountStore('accounts.yaml', self.games, Config().Accounts.journal_limit)
+        else:
+            self.accounts.load()
 
     def extract_kwargs(self, arg):
         args, kwargs = [], {}
@@ -77,25 +101,72 @@ class ToonLinuxShell(Cmd):
         return None
 
     def filter_accounts(self):
-        self.launched_games = {login: game for login, game in self.launched_games.items() if game.is_active()}
+        with self.launched_lock:
+            for key in [key for key, game in self.launched_games.items() if not game.is_active()]:
+                del self.launched_games[key]
+
+    def launched(self) -> list:
+        with self.launched_lock:
+            return list(self.launched_games.items())
 
     def do_accounts(self, arg):
+        if arg == 'save':
+            print('Writing all account changes to accounts.yaml')
+            self.accounts.compact()
+            return
+
         print('Reloading all accounts')
         self.load_toons()
 
+    def is_staging(self, name) -> bool:
+        return self.jobs.is_active(f'stage {name}')
+
     def do_update(self, arg):
         games, kwargs = self.extract_kwargs(arg)
-        if not games:
-            print('Updating all games')
-            for game in self.games.values():
-                game(None).update(force=kwargs.get("force", False))
-        else:
-            for arg in games:
-                if arg in self.games:
-                    print(f'Updating single game: {arg}')
-                    self.games[arg](None).update(force=kwargs.get("force", False))
-                else:
-                    print(f'Unknown game {arg}')
+        for name in games or self.games:
+            if name not in self.games:
+                print(f'Unknown game {name}')
+            elif self.is_staging(name) or self.jobs.is_active(f'update {name}'):
+                print(f'{name} is already being updated or staged, wait for that job to finish')
+            else:
+                job = self.jobs.submit(f'update {name}', self.update_game, name, kwargs.get('force', False),
+                                       kwargs.get('verify', False))
+                print(f'Updating {name} as job {job.id}')
+
+    def update_game(self, name, force, verify):
+        self.games[name](None).update(force=force, verify=verify)
+
+    def do_stage(self, arg):
+        games, kwargs = self.extract_kwargs(arg)
+        for name in games or self.games:
+            if name not in self.games:
+                print(f'Unknown game {name}')
+            elif self.is_staging(name) or self.jobs.is_active(f'update {name}'):
+                print(f'{name} is already being updated or staged')
+            else:
+                # Staging lowers the priority of its thread, so it does not take a worker of the shared pool
+                job = self.jobs.submit(f'stage {name}', self.stage_game, name, kwargs.get('force', False),
+                                       dedicated=True)
+                print(f'Staging the next update of {name} as job {job.id}')
+
+    def stage_game(self, name, force):
+        lower_thread_priority(Config().Updater.staging_nice)
+        self.games[name](None).stage_update(force)
+
+    def apply_staged_updates(self, names):
+        for name in names:
+            # Both would move files into the game directory and rewrite its journal and hash cache
+            if self.is_staging(name) or self.jobs.is_active(f'update {name}'):
+                continue
+            game = self.games[name](None)
+            if not game.updater or not game.updater.has_staged():
+                continue
+            # Running clients have the old files open, swapping them out from under them is not safe
+            if any(game_name == name and client.is_active()
+                   for (game_name, _), client in self.launched()):
+                print(f'A staged update of {name} waits until every client of it is closed')
+                continue
+            game.apply_staged_update()
 
     def do_notoken(self, arg):
         if arg not in self.accounts:
@@ -107,49 +178,184 @@ class ToonLinuxShell(Cmd):
             print('Revoking non-clash tokens is not yet supported.')
             return
 
-        game = self.games[account['game']]()
+        game = self.games[account['game']](account)
         result = game.revoke_token(account.get('token'))
         if result:
             del account['token']
-            self.save_accounts()
+            self.accounts.save(account)
 
     def do_launch(self, arg):
         self.filter_accounts()
         toons, kwargs = self.extract_kwargs(arg)
+        parallel = kwargs.pop('parallel', Config().Shell.parallel_launch)
         if kwargs:
             print('Running with keyword arguments: ', kwargs)
-        for toon in toons:
-            if toon not in self.accounts:
-                print(f'Account {toon} not found')
-                continue
+        self.apply_staged_updates({self.accounts[toon]['game'] for toon in toons if toon in self.accounts})
 
-            account = self.accounts[toon]
-            if (account['game'], account['login']) in self.launched_games and not kwargs.get('force'):
-                print(f'Account {account["login"]} on game {account["game"]} already launched '
-                      '(use force=true to override)')
-                continue
+        if not parallel or len(toons) < 2:
+            if toons:
+                job = self.jobs.submit(f'launch {" ".join(toons)}', self.launch_toons, toons, kwargs, pool='login')
+                print(f'Launching {", ".join(toons)} as job {job.id}')
+            return
 
-            game = self.games[account['game']](account)
-            toon_name = account['display_name']
+        jobs = self.submit_logins(toons, kwargs)
+        # Only waits on the logins, so it does not take a worker they need
+        self.jobs.submit('launch summary', self.summarize_launch, jobs, dedicated=True)
 
-            password_reset = False
-            if 'password' not in account and Config().GameData[account['game']].uses_password:
-                password_reset = True
-                account['password'] = getpass(f'Enter password for {toon_name}: ')
+    def submit_logins(self, toons, kwargs) -> dict:
+        # Aliases of the same account would otherwise race each other
+        unique_toons = {}
+        for toon in toons:
+            account = self.accounts.get(toon)
+            unique_toons.setdefault((account['game'], account['login']) if account else toon, toon)
+
+        # Logins have a pool of their own, so they never wait behind an update
+        jobs = {}
+        for key, toon in unique_toons.items():
+            jobs[key] = self.jobs.submit(f'launch {toon}', self.launch_toon, toon, kwargs, pool='login')
+            print(f'Launching {toon} as job {jobs[key].id}')
+        return jobs
+
+    def summarize_launch(self, jobs):
+        for job in jobs.values():
+            while not job.wait(0.2):
+                checkpoint()
+
+        print('Launch summary:')
+        for job in jobs.values():
+            result = job.future.result() if job.state == 'done' else job.state
+            print(f'  {job.name.removeprefix("launch ")}: {result}')
+
+    def do_group(self, arg):
+        args, kwargs = self.extract_kwargs(arg)
+        if not args:
+            if not self.accounts.groups:
+                print('No launch groups, add them under "groups" in accounts.yaml')
+            for name, toons in self.accounts.groups.items():
+                print(f'{name}: {", ".join(toons)}')
+            return
 
-            login_successful = game.login(**account, **kwargs)
-            if not login_successful:
-                if password_reset:
-                    del account['password']
-                continue
+        name = args[0]
+        if name not in self.accounts.groups:
+            print(f'Launch group {name} not found')
+            return
+
+        settings = Config().Launch
+        stagger = str(kwargs.pop('stagger', settings.stagger))
+        try:
+            gate = LaunchGate(stagger if stagger == 'settle' else float(stagger), settings.settle_cpu,
+                              settings.settle_io, settings.settle_interval, settings.settle_samples,
+                              settings.settle_timeout, partial(self.jobs.submit, pool='login'))
+        except ValueError:
+            print('Usage: group <name> [stagger=<seconds> | stagger=settle]')
+            return
+
+        self.filter_accounts()
+        toons = self.accounts.groups[name]
+        self.apply_staged_updates({self.accounts[toon]['game'] for toon in toons})
+        jobs = self.submit_logins(toons, dict(kwargs, gate=gate))
+        job = self.jobs.submit(f'group {name}', self.finish_group, gate, jobs, dedicated=True)
+        print(f'Launching group {name} as job {job.id}, stagger {stagger}')
+
+    def finish_group(self, gate, jobs) -> str:
+        self.summarize_launch(jobs)
+        # Logins waiting in a queue launch later, the scheduler hands their clients to jobs of their own
+        while any(key in jobs for key, _, _ in login_scheduler.pending()):
+            checkpoint()
+            time.sleep(0.2)
+        for job in gate.deferred:
+            while not job.wait(0.2):
+                checkpoint()
+
+        total = gate.finish()
+        if total is None:
+            return 'no client was started'
+        offsets = ', '.join(f'{toon} +{offset:.1f}s' for toon, offset in gate.launches.items())
+        return f'{len(gate.launches)}/{len(jobs)} in game after {total:.1f}s ({offsets})'
+
+    def launch_toons(self, toons, kwargs) -> str:
+        return ', '.join(f'{toon}: {self.launch_toon(toon, kwargs)}' for toon in toons)
+
+    def launch_toon(self, toon, kwargs) -> str:
+        if toon not in self.accounts:
+            print(f'Account {toon} not found')
+            return 'not found'
+
+        account = self.accounts[toon]
+        if (account['game'], account['login']) in self.launched_games and not kwargs.get('force'):
+            print(f'Account {account["login"]} on game {account["game"]} already launched '
+                  '(use force=true to override)')
+            return 'already launched'
+
+        game = self.games[account['game']](account)
+        toon_name = account['display_name']
+
+        password_reset = False
+        if 'password' not in account and Config().GameData[account['game']].uses_password:
+            password_reset = True
+            account['password'] = ask(f'Enter password for {toon_name}: ', secret=True)
+
+        credentials = {key: account[key] for key in self.login_keys if key in account}
+        login_successful = game.login(**credentials, **kwargs)
+        if not login_successful:
             if password_reset:
-                print('Saving password for this account for the rest of this session')
-            elif game.account_needs_change:
-                print('Saving the account...')
-                self.save_accounts()
+                del account['password']
+            if game.state != LoginState.Queue:
+                return 'login failed'
+            if game.account_needs_change:
+                # A token fetched before the login had to wait is already registered with the server
+                self.accounts.save(account)
+            return 'queued'
+        if password_reset:
+            print('Saving password for this account for the rest of this session')
+        elif game.account_needs_change:
+            print('Saving the account...')
+            self.accounts.save(account)
+
+        self.register_game(game)
+        return 'online'
+
+    def finish_queued_login(self, game):
+        if game.account_needs_change:
+            self.accounts.save(game.account)
+        self.register_game(game)
+
+    def register_game(self, game):
+        print(f'Successfully logged in as {game.account["display_name"]}')
+        with self.launched_lock:
+            self.launched_games[game.account['game'], game.account['login']] = game
+
+    def do_queue(self, arg):
+        args = arg.split()
+        if not args:
+            pending = login_scheduler.pending()
+            if not pending:
+                print('No logins are waiting')
+            for (game, login), status, due in pending:
+                print(f'{login} on {game}: {status}, next attempt in {due:.0f}s')
+            return
+
+        if args[0] != 'cancel' or len(args) != 2:
+            print('Usage: queue [cancel <toon>]')
+            return
+
+        if args[1] not in self.accounts:
+            print(f'Account {args[1]} not found')
+            return
 
-            print(f'Successfully logged in as {toon_name}')
-            self.launched_games[account['game'], account['login']] = game
+        account = self.accounts[args[1]]
+        if login_scheduler.cancel((account['game'], account['login'])):
+            print(f'Cancelled the pending login of {account["display_name"]}')
+        else:
+            print(f'Account {args[1]} is not waiting to log in')
+
+    def do_limits(self, arg):
+        status = rate_limiter.status()
+        if not status:
+            print('No rate-limited endpoints were used yet')
+        for url, tokens, wait, failures in status:
+            print(f'{url}: {tokens:.1f} requests available, next request in {wait:.1f}s, '
+                  f'{failures} rejections in a row')
 
     def do_disconnect(self, arg):
         if arg not in self.accounts:
@@ -164,18 +370,112 @@ class ToonLinuxShell(Cmd):
 
         game.stop()
 
-    # TODO: figure out why this does not work
-    """
     def do_log(self, arg):
-        arg = self.resolve_account(arg)
-        if arg not in self.launched_games:
+        if arg not in self.accounts:
+            print(f'Account {arg} not found')
+            return
+
+        account = self.accounts[arg]
+        game = self.launched_games.get((account['game'], account['login']))
+        if not game:
             print(f'Account {arg} not launched')
             return
 
-        game = self.launched_games[arg]
-        print(game.handler.app.stdout.read().decode('utf-8'))
+        log = output_drainer.get_log(game.log_name())
+        print('\n'.join(log.tail()))
+        print(f'(full log: {log.path})')
 
     def do_logs(self, arg):
-        for account, game in self.launched_games.items():
-            print(f'{account}:', game.handler.app.stdout.read().decode('utf-8'))
-    """
+        for (game_name, login), game in self.launched():
+            print(f'{login} on {game_name}:')
+            for line in output_drainer.get_log(game.log_name()).tail(Config().Logging.summary_lines):
+                print(f'  {line}')
+
+    def do_stats(self, arg):
+        if arg == 'reset':
+            tracer.reset()
+            print('Cleared all timings')
+            return
+
+        if not tracer.enabled:
+            print('Tracing is disabled, set Tracing.enabled in config.yaml and restart')
+            return
+
+        summary = tracer.summary()
+        if not summary:
+            print('Nothing was timed yet')
+        for name, labels, count, mean, (p50, p90, p99), slowest in summary:
+            label_text = ' '.join(f'{key}={value}' for key, value in labels.items())
+            print(f'{name} {label_text}: {count} samples, mean {mean * 1000:.1f}ms, p50 {p50 * 1000:.1f}ms, '
+                  f'p90 {p90 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms, max {slowest * 1000:.1f}ms')
+        tracer.write_prometheus()
+
+    def do_gc(self, arg):
+        settings = Config().BlobStore
+        if not settings.enabled:
+            print('The blob store is disabled, set BlobStore.enabled in config.yaml to use it')
+            return
+
+        dry_run = arg == 'dry'
+        removed, freed = BlobStore(settings.directory, settings.link).collect(dry_run)
+        action = 'Would remove' if dry_run else 'Removed'
+        print(f'{action} {removed} unused blobs, freeing {freed / 1024 / 1024:.1f} MB')
+
+    def do_bwlimit(self, arg):
+        if arg:
+            try:
+                bandwidth_limiter.set_rate(parse_rate(arg))
+            except ValueError:
+                print('Usage: bwlimit [<bytes per second, e.g. 500K or 2M> | off]')
+                return
+
+        rate = bandwidth_limiter.rate
+        print(f'Downloads are limited to {format_rate(rate)}' if rate else 'Downloads are not limited')
+
+    def report_job(self, job):
+        state = job.state
+        if state == 'done':
+            result = job.future.result()
+            print(f'[job {job.id}] {job.name}: done in {job.elapsed():.1f}s' + (f', {result}' if result else ''))
+        elif state == 'failed':
+            error = job.future.exception()
+            print(f'[job {job.id}] {job.name}: failed: {error}')
+            if not isinstance(error, OSError):
+                print(''.join(format_exception(error)).rstrip())
+        else:
+            print(f'[job {job.id}] {job.name}: cancelled')
+
+    def find_job(self, arg):
+        job = self.jobs.get(int(arg)) if arg.isdigit() else None
+        if not job:
+            print(f'Job {arg} not found')
+        return job
+
+    def do_jobs(self, arg):
+        jobs = self.jobs.list()
+        if not jobs:
+            print('No jobs were started yet')
+        for job in jobs:
+            print(f'{job.id}: {job.name} [{job.state}, {job.elapsed():.1f}s]')
+
+    def do_wait(self, arg):
+        job = self.find_job(arg)
+        if not job:
+            return
+
+        try:
+            while not job.wait(0.2):
+                # The job may be waiting for an answer from us
+                console.serve_requests()
+        except KeyboardInterrupt:
+            print(f'Stopped waiting, job {job.id} keeps running')
+
+    def do_cancel(self, arg):
+        job = self.find_job(arg)
+        if not job:
+            return
+
+        if self.jobs.cancel(job.id):
+            print(f'Cancelling job {job.id}, it stops at the next safe point')
+        else:
+            print(f'Job {job.id} already finished')
@@ -0,0 +1,139 @@
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from code.jobs import Job, checkpoint
+
+TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def process_tree(pid: int) -> set:
+    """The process and everything it started, wine hands the game over to child processes."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                # The command name may contain spaces, the fields after it do not
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    tree, todo = set(), [pid]
+    while todo:
+        current = todo.pop()
+        if current not in tree:
+            tree.add(current)
+            todo.extend(children.get(current, []))
+    return tree
+
+
+def tree_usage(pid: int) -> Optional[Tuple[float, int]]:
+    """CPU seconds and bytes read or written from disk so far by a process tree, None once it exited."""
+    cpu, disk = 0.0, 0
+    found = False
+    for member in process_tree(pid):
+        try:
+            with open(f'/proc/{member}/stat', 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            # utime and stime are fields 14 and 15, counted from the pid
+            cpu += (int(fields[11]) + int(fields[12])) / TICKS
+            found = True
+        except (OSError, IndexError, ValueError):
+            continue
+
+        try:
+            with open(f'/proc/{member}/io', 'r') as f:
+                io = dict(line.split(':') for line in f)
+            disk += int(io['read_bytes']) + int(io['write_bytes'])
+        except (OSError, KeyError, ValueError):
+            pass  # not readable without ptrace access, the CPU time still counts
+    return (cpu, disk) if found else None
+
+
+class LaunchGate:
+    """Lets the clients of a launch group start one after another while their logins run in parallel.
+
+    Every client waits until the previous one has been running for a fixed delay, or, with the "settle"
+    stagger, until the previous one stopped loading: its process tree used less than settle_cpu cores and
+    settle_io bytes of disk per second for settle_samples samples in a row.
+    """
+
+    def __init__(self, stagger, settle_cpu: float, settle_io: int, settle_interval: float, settle_samples: int,
+                 settle_timeout: float, submit: Callable[..., Job]):
+        self.settle = stagger == 'settle'
+        self.delay = 0.0 if self.settle else float(stagger)
+        self.settle_cpu = settle_cpu
+        self.settle_io = settle_io
+        self.settle_interval = settle_interval
+        self.settle_samples = settle_samples
+        self.settle_timeout = settle_timeout
+        self.submit = submit
+        self.deferred: List[Job] = []
+
+        self.lock = Lock()
+        self.started = time.monotonic()
+        self.previous = None
+        self.current = None
+        self.launches: Dict[str, float] = {}
+
+    def defer(self, name: str, func: Callable, *args):
+        """Waits for the turn of a client in a job of its own, for callers that can not block."""
+        self.deferred.append(self.submit(f'start {name}', func, *args))
+
+    @contextmanager
+    def turn(self, name: str):
+        with self.lock:
+            self.wait_for_previous()
+            self.current = name
+            yield
+
+    def launched(self, app):
+        now = time.monotonic()
+        self.launches[self.current] = now - self.started
+        self.previous = (app, now)
+
+    def wait_for_previous(self) -> float:
+        """Returns when the previous client is considered in game."""
+        if not self.previous:
+            return time.monotonic()
+        app, launched = self.previous
+        if self.settle:
+            return self.wait_settled(app.pid, launched)
+
+        ready = launched + self.delay
+        while time.monotonic() < ready:
+            checkpoint()
+            time.sleep(min(ready - time.monotonic(), 0.2))
+        return ready
+
+    def wait_settled(self, pid: int, launched: float) -> float:
+        deadline = launched + self.settle_timeout
+        usage, sampled = tree_usage(pid), time.monotonic()
+        calm = 0
+        while usage and calm < self.settle_samples and time.monotonic() < deadline:
+            checkpoint()
+            time.sleep(self.settle_interval)
+            current, now = tree_usage(pid), time.monotonic()
+            if not current:
+                break
+            elapsed = now - sampled
+            cpu, disk = (current[0] - usage[0]) / elapsed, (current[1] - usage[1]) / elapsed
+            calm = calm + 1 if cpu < self.settle_cpu and disk < self.settle_io else 0
+            usage, sampled = current, now
+        return time.monotonic()
+
+    def finish(self) -> Optional[float]:
+        """Waits until the last client settled and returns the seconds from the start of the group until then.
+
+        The last client is waited for the same way with either stagger, so delays and settling can be compared.
+        """
+        with self.lock:
+            if not self.previous:
+                return None
+            app, launched = self.previous
+            return self.wait_settled(app.pid, launched) - self.started
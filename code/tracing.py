@@ -0,0 +1,150 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from threading import Lock
+from typing import List, Tuple
+
+from code.cache import atomic_write
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'labels', 'started', 'wall_started')
+
+    def __init__(self, tracer: 'Tracer', name: str, labels: dict):
+        self.tracer = tracer
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.wall_started = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.started
+        if exc_type is not None:
+            self.labels['status'] = 'error'
+        self.tracer.record(self.name, self.labels, self.wall_started, duration)
+        return False
+
+
+class SpanStats:
+    def __init__(self, window: int):
+        self.recent = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, duration: float):
+        self.recent.append(duration)
+        self.count += 1
+        self.total += duration
+
+    def percentile(self, fraction: float) -> float:
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Tracer:
+    """Collects the durations of login steps, HTTP calls and update stages.
+
+    While tracing is disabled span() hands out a shared do-nothing context manager, so instrumented code
+    only pays for one method call.
+    """
+
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.enabled = False
+        self.window = 500
+        self.jsonl_path = ''
+        self.prometheus_path = ''
+        self.prometheus_interval = 10.0
+        self.lock = Lock()
+        self.export_lock = Lock()
+        self.stats = {}
+        self.jsonl = None
+        self.prometheus_written = 0.0
+
+    def configure(self, enabled: bool, window: int, jsonl: str, prometheus: str, prometheus_interval: float):
+        with self.lock:
+            self.enabled = bool(enabled)
+            self.window = window
+            self.prometheus_path = os.path.expanduser(prometheus)
+            self.prometheus_interval = prometheus_interval
+            if self.jsonl:
+                self.jsonl.close()
+                self.jsonl = None
+            self.jsonl_path = os.path.expanduser(jsonl)
+            if self.enabled and self.jsonl_path:
+                os.makedirs(os.path.dirname(self.jsonl_path) or '.', exist_ok=True)
+                self.jsonl = open(self.jsonl_path, 'a', buffering=1)
+
+    def span(self, name: str, **labels):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, labels)
+
+    def record(self, name: str, labels: dict, started: float, duration: float):
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = SpanStats(self.window)
+            stats.add(duration)
+
+            if self.jsonl:
+                self.jsonl.write(json.dumps(dict(
+                    name=name, labels=labels, start=started, duration=duration,
+                    thread=threading.current_thread().name)) + '\n')
+
+        if self.prometheus_path and time.monotonic() - self.prometheus_written >= self.prometheus_interval:
+            self.write_prometheus()
+
+    def summary(self) -> List[Tuple[str, dict, int, float, Tuple[float, ...], float]]:
+        with self.lock:
+            return [(name, dict(labels), len(stats.recent), stats.total / stats.count,
+                     tuple(stats.percentile(quantile) for quantile in self.quantiles), max(stats.recent))
+                    for (name, labels), stats in sorted(self.stats.items())]
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+    def write_prometheus(self):
+        if not self.prometheus_path:
+            return
+
+        with self.export_lock:
+            self.export_prometheus()
+
+    def export_prometheus(self):
+        lines = ['# HELP toonylinux_span_seconds Duration of login steps, HTTP calls and update stages',
+                 '# TYPE toonylinux_span_seconds summary']
+        with self.lock:
+            self.prometheus_written = time.monotonic()
+            for (name, labels), stats in sorted(self.stats.items()):
+                label_text = ','.join([f'span="{name}"'] + [f'{key}="{value}"' for key, value in labels])
+                for quantile in self.quantiles:
+                    lines.append(f'toonylinux_span_seconds{{{label_text},quantile="{quantile}"}} '
+                                 f'{stats.percentile(quantile):.6f}')
+                lines.append(f'toonylinux_span_seconds_sum{{{label_text}}} {stats.total:.6f}')
+                lines.append(f'toonylinux_span_seconds_count{{{label_text}}} {stats.count}')
+
+        os.makedirs(os.path.dirname(self.prometheus_path) or '.', exist_ok=True)
+        atomic_write(self.prometheus_path, '\n'.join(lines) + '\n')
+
+
+tracer = Tracer()
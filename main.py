@@ -5,11 +5,12 @@ from code.game import corporate_clash, rewritten  # noqa: F401
 
 
 def loop(shell):
-    try:
-        shell.cmdloop()
-    except Exception:
-        print_exc()
-        loop(shell)
+    while True:
+        try:
+            shell.cmdloop()
+            return
+        except Exception:
+            print_exc()
 
 
 if __name__ == '__main__':